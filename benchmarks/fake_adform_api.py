@@ -0,0 +1,193 @@
+"""
+Local stand-in for the Adform token and Master Data API serving synthetic datasets.
+"""
+import gzip
+import json
+import os
+import random
+import re
+import threading
+import zipfile
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+CREATED_AT_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+BASE_COLUMNS = ["GUID", "Timestamp", "CampaignId", "LineItemId", "BannerId", "PublisherDomain", "CityName"]
+DRIFT_COLUMNS = ["DeviceTypeId", "BrowserName", "IsRobot"]
+CITY_NAMES = ["Praha", "Brno", "København", "Århus", "Malmö", "Zürich", "Genève"]
+
+
+@dataclass
+class DatasetSpec:
+    datasets: list[str] = field(default_factory=lambda: ["Click", "Impression", "Event"])
+    files_per_dataset: int = 24
+    rows_per_file: int = 5000
+    # every n-th file has additional columns, 0 disables the column drift
+    drift_every: int = 4
+    charset: str = "UTF-8"
+    meta_files: list[str] = field(default_factory=lambda: ["campaigns", "banners-adgroups"])
+    seed: int = 42
+
+
+class FakeAdformData:
+    """
+    Synthetic gzipped dataset files and meta.zip, generated once into a directory.
+    """
+
+    def __init__(self, spec: DatasetSpec, data_dir: str, setup_id: str = "bench-setup"):
+        self.spec = spec
+        self.data_dir = data_dir
+        self.setup_id = setup_id
+        self.files: list[dict] = []
+        self._generate()
+
+    def _generate(self):
+        os.makedirs(self.data_dir, exist_ok=True)
+        rnd = random.Random(self.spec.seed)
+        now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+        for dataset in self.spec.datasets:
+            for i in range(self.spec.files_per_dataset):
+                created_at = now - timedelta(hours=i + 1)
+                name = f"{dataset}_{created_at.strftime('%Y%m%d%H')}_{self.setup_id}.csv.gz"
+                drift = self.spec.drift_every and i % self.spec.drift_every == 0
+                columns = BASE_COLUMNS + (DRIFT_COLUMNS if drift else [])
+                path = os.path.join(self.data_dir, name)
+                with gzip.open(path, "wt", encoding=self._codec(), newline="") as f:
+                    f.write(",".join(columns) + "\n")
+                    for row in range(self.spec.rows_per_file):
+                        f.write(",".join(self._value(c, dataset, i, row, created_at, rnd) for c in columns) + "\n")
+                self.files.append({
+                    "id": f"{dataset}-{i}",
+                    "name": name,
+                    "setup": self.setup_id,
+                    "createdAt": created_at.strftime(CREATED_AT_FORMAT),
+                    "size": os.path.getsize(path),
+                    "path": path,
+                })
+        # the API returns the newest files first
+        self.files.sort(key=lambda f: f["createdAt"], reverse=True)
+
+        meta_path = os.path.join(self.data_dir, "meta.zip")
+        with zipfile.ZipFile(meta_path, "w", zipfile.ZIP_DEFLATED) as zf:
+            for dim in self.spec.meta_files:
+                rows = [{"id": i, "name": f"{dim} {i}", "campaignId": i % 50} for i in range(1000)]
+                zf.writestr(f"{dim}.json", json.dumps(rows))
+        self.meta_zip_path = meta_path
+
+    def _codec(self) -> str:
+        return "cp850" if self.spec.charset == "IBM850" else self.spec.charset
+
+    @staticmethod
+    def _value(column, dataset, file_index, row, created_at, rnd) -> str:
+        if column == "GUID":
+            return f"{dataset[:2]}{file_index:04d}{row:08d}"
+        if column == "Timestamp":
+            return (created_at - timedelta(seconds=rnd.randint(0, 3599))).strftime("%Y-%m-%d %H:%M:%S")
+        if column == "PublisherDomain":
+            return f"site{rnd.randint(1, 500)}.example.com"
+        if column == "CityName":
+            return rnd.choice(CITY_NAMES)
+        if column == "BrowserName":
+            return rnd.choice(["Chrome", "Firefox", "Safari"])
+        return str(rnd.randint(1, 100000))
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(f["size"] for f in self.files)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    data: FakeAdformData = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.startswith("/token"):
+            self._send_json({"access_token": "bench-access-token", "refresh_token": "bench-refresh-token"})
+        else:
+            self.send_error(404)
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        url = urlparse(self.path)
+        if url.path.startswith("/v1/buyer/masterdata/files/"):
+            query = parse_qs(url.query)
+            offset, limit = int(query.get("offset", [0])[0]), int(query.get("limit", [1000])[0])
+            page = [{k: v for k, v in f.items() if k != "path"} for f in self.data.files[offset:offset + limit]]
+            self._send_json(page, {"Total-Count": str(len(self.data.files))})
+        elif url.path.startswith("/v1/buyer/masterdata/download/"):
+            file_id = url.path.rstrip("/").split("/")[-1]
+            if file_id == "meta__zip":
+                self._send_file(self.data.meta_zip_path, head)
+            else:
+                match = next((f for f in self.data.files if f["id"] == file_id), None)
+                if match:
+                    self._send_file(match["path"], head)
+                else:
+                    self.send_error(404)
+        else:
+            self.send_error(404)
+
+    def _send_file(self, path, head=False):
+        stat = os.stat(path)
+        size = stat.st_size
+        start = 0
+        range_match = re.match(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if range_match:
+            start = int(range_match.group(1))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size - start))
+        self.send_header("ETag", f'"{stat.st_mtime_ns:x}-{size:x}"')
+        self.send_header("Last-Modified", formatdate(stat.st_mtime, usegmt=True))
+        self.end_headers()
+        if head:
+            return
+        with open(path, "rb") as f:
+            f.seek(start)
+            while chunk := f.read(1024 * 1024):
+                self.wfile.write(chunk)
+
+
+class FakeAdformApi:
+    """
+    Serves FakeAdformData on localhost in a background thread, usable as a context manager.
+    """
+
+    def __init__(self, data: FakeAdformData):
+        handler = type("Handler", (_Handler,), {"data": data})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}/"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,189 @@
+"""
+Offline end-to-end benchmark of the component against a local fake Adform API.
+
+Runs Component.run for each scenario and reports wall time of the listing, download, transcode,
+ingest and export stages taken from the run metrics written by the component. The results are
+compared with the stored baselines and the script exits with a non-zero code when a stage regresses.
+
+    python benchmarks/run_benchmark.py [--scenario utf8] [--update-baseline] [--tolerance 1.5]
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from dataclasses import asdict, replace
+
+import mock
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(BENCH_DIR, "..", "src"))
+
+from fake_adform_api import DatasetSpec, FakeAdformApi, FakeAdformData  # noqa: E402
+
+BASELINE_DIR = os.path.join(BENCH_DIR, "baselines")
+# differences below this many seconds are considered noise
+NOISE_FLOOR_SECONDS = 0.5
+
+SCENARIOS = {
+    "utf8": (DatasetSpec(), {}),
+    "utf8_sliced": (DatasetSpec(), {"sliced_output": True}),
+    "ibm850": (DatasetSpec(charset="IBM850"), {}),
+}
+
+
+def _write_config(data_dir: str, data: FakeAdformData, destination: dict):
+    os.makedirs(os.path.join(data_dir, "out", "tables"), exist_ok=True)
+    os.makedirs(os.path.join(data_dir, "out", "files"), exist_ok=True)
+    os.makedirs(os.path.join(data_dir, "in"), exist_ok=True)
+    config = {
+        "parameters": {
+            "source": {
+                "setup_id": data.setup_id,
+                "days_interval": 0,
+                "hours_interval": data.spec.files_per_dataset + 1,
+                "date_to": None,
+                "datasets": data.spec.datasets,
+                "file_charset": data.spec.charset,
+                "meta_files": data.spec.meta_files,
+            },
+            "destination": {"load_type": "full_load", "override_pkey": None, **destination},
+        },
+        "authorization": {
+            "oauth_api": {
+                "credentials": {
+                    "id": "bench",
+                    "appKey": "bench-app",
+                    "#appSecret": "bench-secret",
+                    "#data": json.dumps({"refresh_token": "bench-refresh-token"}),
+                }
+            }
+        },
+    }
+    with open(os.path.join(data_dir, "config.json"), "w") as f:
+        json.dump(config, f)
+
+
+def run_scenario(name: str, data: FakeAdformData, destination: dict, work_dir: str, log_level=logging.WARNING) -> dict:
+    import component
+    from client import api_client
+
+    data_dir = os.path.join(work_dir, name, "data")
+    _write_config(data_dir, data, destination)
+
+    with (
+        FakeAdformApi(data) as api,
+        mock.patch.object(component, "ENDPOINT_TOKEN", f"{api.url}token"),
+        mock.patch.object(api_client, "BASE_URL", api.url),
+        mock.patch.dict(os.environ, {"KBC_DATADIR": data_dir}),
+    ):
+        start = time.perf_counter()
+        comp = component.Component()
+        # the component sets up its own logger
+        logging.getLogger().setLevel(log_level)
+        comp.run()
+        total = time.perf_counter() - start
+
+    with open(os.path.join(data_dir, "out", "files", component.METRICS_FILE_NAME)) as f:
+        metrics = json.load(f)
+    seconds = defaultdict(float)
+    for stage in metrics["stages"]:
+        if stage["stage"] == "download" and stage["dataset"] != "meta":
+            # cumulative time of all download workers, the wait time depends on the processing overlap
+            seconds["download"] += stage.get("worker_seconds", 0)
+        elif (stage["dataset"] or "").startswith("meta") or stage["stage"] == "meta":
+            seconds["meta"] += stage["seconds"]
+        else:
+            seconds[stage["stage"]] += stage["seconds"]
+
+    output_bytes = sum(
+        os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(os.path.join(data_dir, "out", "tables"))
+        for f in files
+    )
+    return {
+        "spec": asdict(data.spec),
+        "destination": destination,
+        "input_bytes": data.total_bytes,
+        "output_bytes": output_bytes,
+        "peak_rss_bytes": metrics["peak_rss_bytes"],
+        "stages": {
+            **{stage: round(seconds[stage], 3) for stage in ("listing", "download", "transcode", "ingest", "export")},
+            "meta": round(seconds["meta"], 3),
+            "total": round(total, 3),
+        },
+    }
+
+
+def compare_with_baseline(name: str, result: dict, tolerance: float) -> list[str]:
+    baseline_path = os.path.join(BASELINE_DIR, f"{name}.json")
+    if not os.path.exists(baseline_path):
+        logging.warning(f"No baseline stored for scenario {name}")
+        return []
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    regressions = []
+    for stage, seconds in result["stages"].items():
+        expected = baseline["stages"].get(stage)
+        if expected is None:
+            continue
+        if seconds > expected * tolerance and seconds - expected > NOISE_FLOOR_SECONDS:
+            regressions.append(f"{name}.{stage}: {seconds:.3f}s (baseline {expected:.3f}s)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="defaults to all scenarios")
+    parser.add_argument("--files", type=int, help="override number of files per dataset")
+    parser.add_argument("--rows", type=int, help="override number of rows per file")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="allowed slowdown against the baseline")
+    parser.add_argument("--update-baseline", action="store_true", help="store the results as new baselines")
+    parser.add_argument("--output", help="write all results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="show the component logs")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="adform-bench-")
+    # the component derives its temporary directories from TMPDIR when imported
+    os.environ["TMPDIR"] = os.path.join(work_dir, "tmp")
+    os.makedirs(os.environ["TMPDIR"])
+
+    results, regressions = {}, []
+    # scenarios with the same dataset spec share the generated files
+    generated = {}
+    try:
+        for name in args.scenario or sorted(SCENARIOS):
+            spec, destination = SCENARIOS[name]
+            overrides = {"files_per_dataset": args.files, "rows_per_file": args.rows}
+            spec = replace(spec, **{k: v for k, v in overrides.items() if v is not None})
+
+            log_level = logging.INFO if args.verbose else logging.WARNING
+            spec_key = json.dumps(asdict(spec), sort_keys=True)
+            if spec_key not in generated:
+                generated[spec_key] = FakeAdformData(spec, os.path.join(work_dir, f"source_{len(generated)}"))
+            result = run_scenario(name, generated[spec_key], destination, work_dir, log_level)
+            results[name] = result
+            print(f"{name}: " + ", ".join(f"{stage}={sec:.3f}s" for stage, sec in result["stages"].items()))
+
+            if args.update_baseline:
+                with open(os.path.join(BASELINE_DIR, f"{name}.json"), "w") as f:
+                    json.dump(result, f, indent=2)
+            else:
+                regressions += compare_with_baseline(name, result, args.tolerance)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        print("Regressions against baseline:\n  " + "\n  ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
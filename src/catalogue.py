@@ -0,0 +1,95 @@
+import math
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+
+CREATED_AT_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def _epoch(created_at: str) -> int:
+    return int(datetime.fromisoformat(created_at.replace("Z", "+00:00")).timestamp())
+
+
+class _DatasetFiles:
+    """
+    Files of one dataset sorted by createdAt, kept in parallel arrays.
+    """
+
+    def __init__(self):
+        self.created = array("q")
+        self.sizes = array("q")  # -1 when the size is not known
+        self.ids: list[str] = []
+        self.names: list[str] = []
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, entries: list[tuple[int, int, str, str]]) -> None:
+        """
+        Adds (createdAt, size, id, name) entries, new files are usually the latest and are just appended.
+        """
+        entries = sorted(entries)
+        if self.created and entries[0][0] < self.created[-1]:
+            entries = sorted([*zip(self.created, self.sizes, self.ids, self.names), *entries])
+            self.__init__()
+        for created, size, file_id, name in entries:
+            self.created.append(created)
+            self.sizes.append(size)
+            self.ids.append(file_id)
+            self.names.append(name)
+
+
+class FileCatalogue:
+    """
+    Compact index of the listed setup files.
+
+    Files of each dataset are sorted by createdAt (epoch seconds), so the files of an interval are found by
+    bisection instead of parsing and comparing every listed file. The API does not guarantee any order of the
+    file list nor list just the new files, so the index is built from the listing of each run.
+    """
+
+    def __init__(self, setup_id: str, datasets: list[str]):
+        self.setup_id = setup_id
+        self.datasets = {prefix: _DatasetFiles() for prefix in datasets}
+
+    def __len__(self) -> int:
+        return sum(len(files) for files in self.datasets.values())
+
+    def update(self, files: list[dict]) -> None:
+        """
+        Adds the listed files of the datasets not indexed yet.
+        """
+        known = {file_id for files in self.datasets.values() for file_id in files.ids}
+        new_entries = {prefix: [] for prefix in self.datasets}
+        for file in files:
+            if file["id"] in known:
+                continue
+            prefix = next((p for p in self.datasets if file["name"].startswith(p)), None)
+            if prefix is None:
+                continue
+            known.add(file["id"])
+            size = int(file["size"]) if file.get("size") is not None else -1
+            new_entries[prefix].append((_epoch(file["createdAt"]), size, file["id"], file["name"]))
+        for prefix, entries in new_entries.items():
+            if entries:
+                self.datasets[prefix].add(entries)
+
+    def select(self, start: datetime, end: datetime, datasets: list[str]) -> list[dict]:
+        """
+        Returns files of the datasets created within the interval including its end, ordered by createdAt.
+        """
+        start, end = math.ceil(start.timestamp()), int(end.timestamp())
+        selected = []
+        for prefix in datasets:
+            files = self.datasets[prefix]
+            for i in range(bisect_left(files.created, start), bisect_right(files.created, end)):
+                file = {
+                    "id": files.ids[i],
+                    "name": files.names[i],
+                    "setup": self.setup_id,
+                    "createdAt": datetime.fromtimestamp(files.created[i], timezone.utc).strftime(CREATED_AT_FORMAT),
+                }
+                if files.sizes[i] >= 0:
+                    file["size"] = files.sizes[i]
+                selected.append(file)
+        return selected
@@ -1,51 +1,462 @@
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import zlib
+from collections import deque
 from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from itertools import islice
+from typing import Optional
+
+import backoff
+import requests
 from keboola.http_client import HttpClient
-import os
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 BASE_URL = "https://api.adform.com/"
 MD_FILES_URL_PATH = "/v1/buyer/masterdata/files/"
 DOWNLOAD_F_URL_PATH = "/v1/buyer/masterdata/download/"
 
 PAGE_SIZE = 1000
+CREATED_AT_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+DEFAULT_MAX_WORKERS = 4
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_MAX_TRIES = 5
+THROTTLE_STATUS_CODES = (429, 500, 502, 503, 504)
+PART_FILE_SUFFIX = ".part"
+# the header line of the datasets fits well into the first compressed chunk
+HEADER_PROBE_BYTES = 64 * 1024
+
+
+class DownloadVerificationError(Exception):
+    """Downloaded file is incomplete or corrupted."""
+
+
+@dataclass
+class DownloadResult:
+    file: dict
+    path: Optional[str] = None
+    size: int = 0
+    seconds: float = 0.0
+    error: Optional[Exception] = None
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Bounds the number of in-flight downloads. The limit is halved whenever the API throttles us
+    (429/5xx) and grows back by one with every successful download.
+    """
+
+    def __init__(self, max_limit: int):
+        self.max_limit = max(1, max_limit)
+        self.limit = self.max_limit
+        self._active = 0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            while self._active >= self.limit:
+                self._condition.wait()
+            self._active += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def decrease(self):
+        with self._condition:
+            new_limit = max(1, self.limit // 2)
+            if new_limit < self.limit:
+                logging.warning(f"Adform API is throttling, lowering download concurrency to {new_limit}")
+            self.limit = new_limit
+
+    def increase(self):
+        with self._condition:
+            if self.limit < self.max_limit:
+                self.limit += 1
+                self._condition.notify_all()
+
+
+def _total_size(response: requests.Response) -> Optional[int]:
+    """
+    Returns full size of the downloaded file from Content-Range (partial response) or Content-Length header.
+    """
+    content_range = re.match(r"bytes \d+-\d+/(\d+)", response.headers.get("Content-Range", ""))
+    if content_range:
+        return int(content_range.group(1))
+    if response.status_code == 200 and response.headers.get("Content-Length"):
+        return int(response.headers["Content-Length"])
+    return None
+
+
+class GzipStreamValidator:
+    """
+    Decompresses gzip data as it is downloaded and discards the output, so a corrupted file fails on the first
+    bad chunk and a complete file is verified (CRC and length of every member) without being read again.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._empty = True
+
+    def feed(self, data: bytes) -> None:
+        try:
+            while data:
+                if self._decompressor.eof:
+                    # a gzip file may consist of more members and may be padded with zeroes
+                    data = data.lstrip(b"\0")
+                    if not data:
+                        return
+                    self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                self._empty = False
+                self._decompressor.decompress(data, DOWNLOAD_CHUNK_SIZE)
+                data = self._decompressor.unconsumed_tail or self._decompressor.unused_data
+        except zlib.error as e:
+            raise DownloadVerificationError(f"File {self.name} is not a valid gzip: {e}") from e
+
+    def feed_file(self, path: str) -> None:
+        with open(path, "rb") as f:
+            while chunk := f.read(DOWNLOAD_CHUNK_SIZE):
+                self.feed(chunk)
+
+    def close(self) -> None:
+        if not self._empty and not self._decompressor.eof:
+            raise DownloadVerificationError(f"File {self.name} is not a valid gzip: compressed data ended early")
+
+
+def _is_permanent_error(e: Exception) -> bool:
+    response = getattr(e, "response", None)
+    return response is not None and response.status_code not in THROTTLE_STATUS_CODES
+
+
+def _on_download_backoff(details: dict) -> None:
+    client = details["args"][0]
+    if client.metrics:
+        client.metrics.add("download", retries=1)
+    if isinstance(details.get("exception"), requests.exceptions.HTTPError):
+        client.limiter.decrease()
 
 
 class AdformClient(HttpClient):
-    def __init__(self, api_token, setup_id):
+    def __init__(
+        self,
+        api_token,
+        setup_id,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        cache_dir: Optional[str] = None,
+        metrics=None,
+    ):
         super().__init__(BASE_URL)
         self.update_auth_header({"Authorization": f'Bearer {api_token}'})
         self.setup_id = setup_id
+        self.max_workers = max(1, max_workers)
+        self.cache_dir = os.path.abspath(cache_dir) if cache_dir else None
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self.limiter = AdaptiveConcurrencyLimiter(self.max_workers)
+        # optional metrics.RunMetrics collecting the requests statistics
+        self.metrics = metrics
+        self._session = self._init_session()
 
-    def retrieve_file_list(self) -> Iterator[dict]:
-        offset = 0
-        while True:
-            endpoint = f"{MD_FILES_URL_PATH}{self.setup_id}"
-            params = {
-                "limit": PAGE_SIZE,
-                "offset": offset
-            }
-            headers = {"Return-Total-Count": "true"}
+    def _init_session(self) -> requests.Session:
+        """
+        Session shared by all listing and download workers, so connections to the API are kept alive and reused.
+        Status based retries are handled in _download_verified to be able to adapt the concurrency.
+        """
+        session = requests.Session()
+        retry = Retry(total=3, connect=3, read=3, status=0, backoff_factor=self.backoff_factor)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers, max_retries=retry)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update(self._auth_header)
+        return session
 
-            response = self.get(endpoint, params=params, headers=headers)
+    def retrieve_file_list(
+        self,
+        created_from: Optional[datetime] = None,
+        created_to: Optional[datetime] = None,
+        prefixes: Optional[list[str]] = None,
+    ) -> Iterator[dict]:
+        """
+        Yields files of the setup created within the interval whose name starts with one of the prefixes.
 
-            data = response
-            if not data:  # No more results
-                break
+        The first page tells the total count of files, the remaining pages are then fetched concurrently.
+        The API does not guarantee any order of the list, so all the pages are read and filtered.
+        """
+        # createdAt is an ISO 8601 UTC string, so it can be compared lexicographically
+        from_str = created_from.strftime(CREATED_AT_FORMAT) if created_from else None
+        to_str = created_to.strftime(CREATED_AT_FORMAT) if created_to else None
 
-            for item in data:
+        for page in self._iter_file_list_pages():
+            for item in page:
+                created_at = item["createdAt"]
+                if (from_str and created_at < from_str) or (to_str and created_at > to_str):
+                    continue
+                if prefixes is not None and not any(item["name"].startswith(p) for p in prefixes):
+                    continue
                 yield item
 
-            if len(data) < PAGE_SIZE:  # Last page
-                break
+    def _iter_file_list_pages(self) -> Iterator[list[dict]]:
+        first_page, total_count = self._get_file_list_page(0)
+        yield first_page
+        if len(first_page) < PAGE_SIZE:  # Last page
+            return
 
-            offset += PAGE_SIZE
+        if total_count is None:  # count not returned, pages are read one by one until a short one
+            offset = PAGE_SIZE
+            while True:
+                page, _ = self._get_file_list_page(offset)
+                if page:
+                    yield page
+                if len(page) < PAGE_SIZE:
+                    return
+                offset += PAGE_SIZE
 
-    def download_file(self, file_dict, dir_path):
-        endpoint = f"{DOWNLOAD_F_URL_PATH}{file_dict['setup']}/{file_dict['id']}"
-        response = self.get_raw(endpoint, stream=True)
+        offsets = iter(range(PAGE_SIZE, total_count, PAGE_SIZE))
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            # at most max_workers pages are requested ahead of the consumer
+            pending = deque(
+                executor.submit(self._get_file_list_page, offset) for _, offset in zip(range(self.max_workers), offsets)
+            )
+            while pending:
+                page, _ = pending.popleft().result()
+                next_offset = next(offsets, None)
+                if next_offset is not None:
+                    pending.append(executor.submit(self._get_file_list_page, next_offset))
+                yield page
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    @backoff.on_exception(
+        backoff.expo, requests.exceptions.RequestException, max_tries=DOWNLOAD_MAX_TRIES, giveup=_is_permanent_error
+    )
+    def _get_file_list_page(self, offset: int) -> tuple[list[dict], Optional[int]]:
+        """
+        :return: files on the page and the total count of files if returned by the API
+        """
+        endpoint = f"{MD_FILES_URL_PATH}{self.setup_id}"
+        params = {
+            "limit": PAGE_SIZE,
+            "offset": offset
+        }
+        headers = {"Return-Total-Count": "true"}
+
+        response = self._session.get(self._build_url(endpoint), params=params, headers=headers)
         response.raise_for_status()
+        if self.metrics:
+            self.metrics.add("listing", pages=1, bytes=len(response.content))
+
+        total_count = response.headers.get("Total-Count")
+        return response.json() or [], int(total_count) if total_count and total_count.isdigit() else None
+
+    def download_file(self, file_dict, dir_path, use_cache: bool = True) -> str:
+        """
+        Downloads the file into dir_path and returns its full path.
+
+        If the cache directory is set, the file is downloaded into the cache first and linked to dir_path.
+        Files already present in the cache (and matching the size from the file list, if provided) are not
+        downloaded again. use_cache=False must be used for files whose content changes under the same id.
+        """
         dir_path = os.path.abspath(dir_path)
         full_path = os.path.join(dir_path, file_dict['name'])
 
-        with open(full_path, "wb") as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
+        cache_path = None
+        if use_cache and self.cache_dir:
+            cache_path = os.path.join(self.cache_dir, f"{file_dict['id']}_{file_dict['name']}")
+            if self._is_cached(cache_path, file_dict):
+                logging.debug(f"File {file_dict['name']} found in cache, skipping download")
+                if self.metrics:
+                    self.metrics.add("download", cache_hits=1)
+                self._link(cache_path, full_path)
+                return full_path
+
+        self._download_verified(file_dict, cache_path or full_path)
+        if cache_path:
+            self._link(cache_path, full_path)
+        return full_path
+
+    @backoff.on_exception(
+        backoff.expo,
+        (requests.exceptions.RequestException, DownloadVerificationError),
+        max_tries=DOWNLOAD_MAX_TRIES,
+        giveup=_is_permanent_error,
+        on_backoff=_on_download_backoff,
+    )
+    def _download_verified(self, file_dict, path) -> None:
+        """
+        Streams the file into a temporary part file, which is renamed to path once it is complete and verified.
+
+        If a part file is left from an interrupted attempt, the transfer is resumed using a Range request.
+        """
+        endpoint = f"{DOWNLOAD_F_URL_PATH}{file_dict['setup']}/{file_dict['id']}"
+        part_path = f"{path}{PART_FILE_SUFFIX}"
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+        with self.limiter:
+            with self._session.get(self._build_url(endpoint), headers=headers, stream=True) as response:
+                if offset and response.status_code == 416:
+                    os.remove(part_path)
+                    raise DownloadVerificationError(f"Cannot resume download of {file_dict['name']}, restarting")
+                response.raise_for_status()
+
+                resumed = offset > 0 and response.status_code == 206
+                if offset and not resumed:
+                    logging.debug(f"Range requests not supported for {file_dict['name']}, restarting download")
+                expected_size = _total_size(response)
+
+                validator = GzipStreamValidator(file_dict['name']) if file_dict['name'].endswith(".gz") else None
+                try:
+                    if validator and resumed:
+                        validator.feed_file(part_path)
+                    # raw bytes are stored as they are sent, so the size matches headers and the Range offsets
+                    with open(part_path, "ab" if resumed else "wb") as f:
+                        for chunk in response.raw.stream(DOWNLOAD_CHUNK_SIZE, decode_content=False):
+                            if validator:
+                                validator.feed(chunk)
+                            f.write(chunk)
+                except DownloadVerificationError:
+                    # the transfer is stopped at the first corrupted chunk and the next attempt starts over
+                    os.remove(part_path)
+                    raise
+
+        size = os.path.getsize(part_path)
+        if expected_size is not None and size < expected_size:
+            # part file is kept, next attempt continues where this one stopped
+            raise DownloadVerificationError(f"Download of {file_dict['name']} incomplete: {size}/{expected_size} B")
+        if expected_size is not None and size > expected_size:
+            os.remove(part_path)
+            raise DownloadVerificationError(f"Download of {file_dict['name']} is larger than expected")
+        if validator:
+            try:
+                validator.close()
+            except DownloadVerificationError:
+                os.remove(part_path)
+                raise
+
+        os.replace(part_path, path)
+        self.limiter.increase()
+
+    def get_file_fingerprint(self, file_dict) -> dict:
+        """
+        Returns ETag, Last-Modified and size of the file from a HEAD request without downloading it.
+
+        Only the headers the API provides are returned, an empty dict if the request fails.
+        """
+        endpoint = f"{DOWNLOAD_F_URL_PATH}{file_dict['setup']}/{file_dict['id']}"
+        try:
+            response = self._session.head(self._build_url(endpoint), allow_redirects=True)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logging.debug(f"Unable to get headers of {file_dict['name']}: {e}")
+            return {}
+        fingerprint = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "size": response.headers.get("Content-Length"),
+        }
+        return {key: value for key, value in fingerprint.items() if value}
+
+    @backoff.on_exception(
+        backoff.expo,
+        requests.exceptions.RequestException,
+        max_tries=DOWNLOAD_MAX_TRIES,
+        giveup=_is_permanent_error,
+    )
+    def read_file_head(self, file_dict) -> bytes:
+        """
+        Returns the beginning of the (decompressed) file content containing at least its first line,
+        without downloading the whole file.
+
+        Only the beginning of the file is requested using a Range request and decompressed until the first newline.
+        """
+        endpoint = f"{DOWNLOAD_F_URL_PATH}{file_dict['setup']}/{file_dict['id']}"
+        headers = {"Range": f"bytes=0-{HEADER_PROBE_BYTES - 1}"}
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if file_dict['name'].endswith(".gz") else None
+        content = b""
+        with self.limiter:
+            with self._session.get(self._build_url(endpoint), headers=headers, stream=True) as response:
+                response.raise_for_status()
+                # the server may ignore the Range header, the rest of the response is then not read
+                for chunk in response.raw.stream(HEADER_PROBE_BYTES, decode_content=False):
+                    content += decompressor.decompress(chunk) if decompressor else chunk
+                    if b"\n" in content:
+                        break
+        return content
+
+    def read_file_heads(self, files: list[dict]) -> list[bytes]:
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self.read_file_head, files))
+
+    @staticmethod
+    def _is_cached(cache_path: str, file_dict: dict) -> bool:
+        if not os.path.isfile(cache_path):
+            return False
+        expected_size = file_dict.get("size")
+        return expected_size is None or os.path.getsize(cache_path) == int(expected_size)
+
+    @staticmethod
+    def _link(src: str, dst: str) -> None:
+        if os.path.lexists(dst):
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)
+
+    def download_files(self, files: list[dict], dir_path) -> list[DownloadResult]:
+        """
+        Downloads the files in parallel using up to max_workers threads.
+
+        Errors do not interrupt the other downloads, they are collected in the returned results
+        which keep the order of the input files.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(lambda f: self._download_result(f, dir_path), files))
+
+    def download_batches(
+        self, batches: list[list[dict]], dir_path, prefetch: int = 1
+    ) -> Iterator[list[DownloadResult]]:
+        """
+        Downloads the batches of files in order and yields the results of each batch once it is complete.
+
+        The following batches (prefetch of them) are downloaded while the caller processes the yielded one,
+        at most prefetch + 1 batches are on the disk at the same time if the caller removes the processed files.
+        """
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        remaining = iter(batches)
+        pending = deque()
+        try:
+            for batch in islice(remaining, prefetch + 1):
+                pending.append([executor.submit(self._download_result, f, dir_path) for f in batch])
+            while pending:
+                current = pending.popleft()
+                for batch in islice(remaining, 1):
+                    pending.append([executor.submit(self._download_result, f, dir_path) for f in batch])
+                yield [future.result() for future in current]
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _download_result(self, file_dict: dict, dir_path) -> DownloadResult:
+        start = time.perf_counter()
+        try:
+            path = self.download_file(file_dict, dir_path)
+            return DownloadResult(
+                file=file_dict, path=path, size=os.path.getsize(path), seconds=time.perf_counter() - start
+            )
+        except (requests.exceptions.RequestException, DownloadVerificationError, OSError) as e:
+            return DownloadResult(file=file_dict, error=e)
+
+    def close(self):
+        self._session.close()
@@ -1,29 +1,89 @@
 import os
+import codecs
 import gzip
+import hashlib
+import multiprocessing
+import shutil
 import zipfile
+import copy
 import json
 import logging
-from collections import OrderedDict
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from fnmatch import fnmatch
+from typing import TYPE_CHECKING, Optional
 
 import requests
 import backoff
-import duckdb
-from duckdb.duckdb import DuckDBPyConnection
 from keboola.component.base import ComponentBase
 from keboola.component.dao import SupportedDataTypes, BaseType, ColumnDefinition
 from keboola.component.exceptions import UserException
 from requests.exceptions import HTTPError
 
-from configuration import Configuration
-from client.api_client import AdformClient
+from configuration import Configuration, Advanced, Backfill
+from catalogue import FileCatalogue
+from client.api_client import AdformClient, DownloadVerificationError
+from csv_scan import (
+    CsvDialect,
+    CsvScan,
+    infer_types_sql,
+    parse_header,
+    pick_types,
+    quarantine_select_sql,
+    quote_identifier,
+    row_filter_sql,
+    typed_select_sql,
+)
+from rollups import RollupQuery, merge_sql, rollup_columns
+from metrics import RunMetrics, directory_size
+from resources import (
+    ResourceLimits,
+    detect_resource_limits,
+    duckdb_memory_limit,
+    duckdb_temp_directory_limit,
+)
+
+if TYPE_CHECKING:
+    from duckdb import DuckDBPyConnection
 
 DUCK_DB_MAX_MEMORY = "400MB"
 DUCK_DB_DIR = os.path.join(os.environ.get("TMPDIR", "/tmp"), "duckdb")
 FILES_TEMP_DIR = os.path.join(os.environ.get("TMPDIR", "/tmp"), "files")
+TRANSCODED_DIR = os.path.join(FILES_TEMP_DIR, "utf8")
+
+META_DIR = os.path.join(FILES_TEMP_DIR, "meta")
+
+TRANSCODE_CHUNK_SIZE = 1024 * 1024
+TYPE_SAMPLE_ROWS = 10000
+TRANSCODE_COMPRESS_LEVEL = 1
+# charsets DuckDB can read directly
+UTF8_COMPATIBLE_CHARSETS = ("UTF-8", "US-ASCII", "Not available")
+# Java charset names offered in the configuration which Python codecs do not know
+CHARSET_CODECS = {
+    "IBM00858": "cp858",
+    "x-IBM737": "cp737",
+    "x-IBM874": "cp874",
+    "x-UTF-16LE-BOM": "utf-16",
+    "x-UTF-32BE-BOM": "utf-32",
+    "x-UTF-32LE-BOM": "utf-32",
+}
 
 STATE_AUTH_ID = "auth_id"
 STATE_REFRESH_TOKEN = "#refresh_token"
+STATE_PROCESSED_FILES = "processed_files"
+STATE_DATASET_COLUMNS = "dataset_columns"
+STATE_META_ZIP = "meta_zip"
+STATE_BACKFILL = "backfill"
+STATE_FILE_CATALOGUE = "file_catalogue"
+
+METRICS_FILE_NAME = "run_metrics.json"
+METRICS_FILE_TAGS = ["adform-run-metrics"]
+
+ADFORM_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 
 ENDPOINT_AUTHORIZE = "https://id.adform.com/sts/connect/authorize"
 ENDPOINT_TOKEN = "https://id.adform.com/sts/connect/token"
@@ -32,107 +92,897 @@ ENDPOINT_TOKEN = "https://id.adform.com/sts/connect/token"
 class Component(ComponentBase):
     def __init__(self):
         super().__init__()
+        self.state = self.get_state_file()
+        self._token_persistence: Optional[Future] = None
         self.token = self._get_access_token()
-        self.duck = self.init_duckdb()
+        self.resource_limits = detect_resource_limits()
+        self.advanced = Advanced()
+        self._duck = None
+        self._duck_lock = threading.Lock()
+        self.slice_size_mb = None
+        self.deduplicate = False
+        self.dedup_order_by = None
+        self.metrics = None
+        self.scans = {}
+        self.dataset_selection = {}
+        self.selections = {}
+        self.batch_columns = {}
+        self.batch_outputs = {}
+        self.rollups = {}
+        self.rollups_only = False
+        self.rollup_tables = {}
+        self.typed_output = False
+        self.quarantine_outputs = {}
+        self.quarantined_files = {}
         os.makedirs(os.path.dirname(FILES_TEMP_DIR), exist_ok=True)
         os.makedirs(FILES_TEMP_DIR, exist_ok=True)
 
+    @property
+    def duck(self) -> "DuckDBPyConnection":
+        # DuckDB is started on the first use, the listing and downloads do not wait for it
+        if self._duck is None:
+            with self._duck_lock:
+                if self._duck is None:
+                    self._duck = self.init_duckdb(self.advanced, self.resource_limits)
+        return self._duck
+
+    @duck.setter
+    def duck(self, connection: "DuckDBPyConnection") -> None:
+        self._duck = connection
+
+    def execute_action(self):
+        try:
+            result = super().execute_action()
+        except BaseException:
+            # the token is saved before exit, but the original error is the one reported
+            try:
+                self.wait_for_token_persistence()
+            except Exception as e:
+                logging.warning(f"Failed to save the refresh token: {e}")
+            raise
+        self.wait_for_token_persistence()
+        return result
+
     def run(self):
         params = Configuration(**self.configuration.parameters)
 
         setup_id = params.source.setup_id
-        days_interval = params.source.days_interval
-        hours_interval = params.source.hours_interval
-        datasets = params.source.datasets
+        meta_files = params.source.meta_files
+
+        self.metrics = RunMetrics(spill_directory=params.advanced.duckdb_temp_directory or DUCK_DB_DIR)
+        self.advanced = params.advanced
+        if params.destination.sliced_output:
+            self.slice_size_mb = params.destination.slice_size_mb
+        self.deduplicate = params.destination.deduplicate
+        self.dedup_order_by = params.destination.dedup_order_by
+        self.dataset_selection = {selection.dataset: selection for selection in params.source.dataset_selection}
+        for rollup in params.destination.rollups:
+            if rollup.dataset not in params.source.datasets:
+                logging.warning(f"Rollup {rollup.name} is skipped, dataset {rollup.dataset} is not loaded")
+            self.rollups.setdefault(rollup.dataset, []).append(rollup)
+        self.rollups_only = params.destination.rollups_only
+        self.typed_output = params.destination.typed_output
+
+        client = AdformClient(
+            self.token,
+            setup_id,
+            max_workers=params.source.download_workers,
+            cache_dir=params.source.download_cache_dir,
+            metrics=self.metrics,
+        )
+
+        if params.source.backfill:
+            self.load_backfill(client, params)
+        else:
+            self.load_interval(client, params)
 
-        date_to = params.source.date_to
+        if self.quarantined_files:
+            names = ", ".join(sorted(f["name"] for f in self.quarantined_files.values()))
+            logging.warning(f"{len(self.quarantined_files)} corrupted files were quarantined and not loaded: {names}")
+
+        if meta_files:
+            self.process_meta_files(client, setup_id, meta_files, params.source.always_get_meta)
+        self.write_state_file(self.state)
+
+        client.close()
+        self.wait_for_token_persistence()
+        self.write_metrics()
+        print("Component finished successfully")
+
+    def load_interval(self, client: AdformClient, params: Configuration) -> None:
+        """
+        Loads the dataset files created in the configured interval, files ingested by previous incremental
+        runs are skipped.
+        """
+        datasets = params.source.datasets
+        file_charset = params.source.file_charset
         custom_pkeys = params.destination.override_pkey
         incremental = params.destination.incremental
+        start_interval, end_interval = self._calculate_start_interval(
+            params.source.date_to, params.source.days_interval, params.source.hours_interval
+        )
+        # files ingested by previous runs are skipped only for incremental loads, full load needs the whole window
+        processed_files = self.state.get(STATE_PROCESSED_FILES, {}) if incremental else {}
+
+        files = self.list_files(client, start_interval, end_interval, datasets)
+        filtered_files = self.skip_processed_files(files, processed_files)
+
+        # each dataset is ingested as soon as its files are downloaded, while the next dataset is being downloaded
+        dataset_files = {prefix: [f for f in filtered_files if f["name"].startswith(prefix)] for prefix in datasets}
+        dataset_files = {prefix: prefix_files for prefix, prefix_files in dataset_files.items() if prefix_files}
+        plan = self.plan_batches(client, dataset_files, file_charset, params.advanced.batch_disk_budget_mb)
+        logging.info(f"Downloading {len(filtered_files)} files using {client.max_workers} workers")
+
+        downloads = client.download_batches([batch for *_, batch in plan], FILES_TEMP_DIR)
+        written_batches = defaultdict(int)
+        for prefix, index, count, batch in plan:
+            # time spent waiting for the downloads, the download of the next batch overlaps with the processing
+            with self.metrics.stage("download", prefix):
+                results = next(downloads)
+            quarantined = self._check_download_results(results)
+            downloaded_bytes = sum(r.size for r in results)
+            self.metrics.add(
+                "download",
+                prefix,
+                files=len(results),
+                bytes=downloaded_bytes,
+                worker_seconds=sum(r.seconds for r in results),
+            )
+            logging.info(f"Downloaded {downloaded_bytes} bytes of dataset {prefix}")
+
+            batch = [f for f in batch if f["id"] not in quarantined]
+            if batch:
+                logging.info(f"Processing dataset: {prefix}" + (f", batch {index + 1}/{count}" if count > 1 else ""))
+                self.save_to_table(
+                    prefix, batch, file_charset, custom_pkeys, incremental, written_batches[prefix], index + 1 == count
+                )
+                written_batches[prefix] += 1
+            self._remove_files([r.path for r in results if r.path])
+        downloads.close()
+        # outputs whose last batch consisted only of quarantined files
+        self.finalize_outputs()
+
+        if incremental:
+            # quarantined files are not recorded, so the following runs try to load them again
+            loaded_files = [f for f in filtered_files if f["id"] not in self.quarantined_files]
+            self.state[STATE_PROCESSED_FILES] = self.update_processed_files(
+                processed_files, loaded_files, datasets, start_interval
+            )
+        else:
+            self.state.pop(STATE_PROCESSED_FILES, None)
+
+    def load_backfill(self, client: AdformClient, params: Configuration) -> None:
+        """
+        Loads the backfill date range in windows of window_hours, windows loaded by previous runs are skipped.
+
+        Files of the following parallel_windows windows are downloaded while a window is ingested. Each loaded
+        window is recorded in the state, so a window whose download fails and the windows not started within
+        max_runtime_minutes are loaded by the next run. All the windows are appended to the same output tables.
+        """
+        backfill = params.source.backfill
+        datasets = params.source.datasets
         file_charset = params.source.file_charset
-        meta_files = params.source.meta_files
+        custom_pkeys = params.destination.override_pkey
+        if not params.destination.incremental:
+            raise UserException("Backfill requires the incremental load type, each run loads only a part of the range")
+        deadline = time.monotonic() + backfill.max_runtime_minutes * 60 if backfill.max_runtime_minutes else None
+
+        start_date, end_date = self._parse_backfill_range(backfill)
+        checkpoint = self._backfill_checkpoint(backfill, start_date, end_date)
+        windows = self.split_into_windows(start_date, end_date, backfill.window_hours)
+        pending = [w for w in windows if w[0].strftime(ADFORM_DATE_FORMAT) not in checkpoint["completed"]]
+        if not pending:
+            logging.info("All windows of the backfill range are already loaded")
+            return
+        logging.info(f"Backfill: {len(pending)} of {len(windows)} windows of {backfill.window_hours} hours to load")
+
+        files = self.list_files(client, pending[0][0], pending[-1][1], datasets)
+        window_files = self.assign_files_to_windows(files, windows)
+        plan = [(window, window_files[window[0]]) for window in pending]
+        # the windows are appended to the output, so it is created with the columns of all the files
+        for prefix in datasets:
+            prefix_files = [f for _, files in plan for f in files if f["name"].startswith(prefix)]
+            if prefix_files:
+                self.batch_columns[prefix] = self.probe_dataset_columns(client, prefix, prefix_files, file_charset)
+        if self.deduplicate:
+            logging.warning("Rows are deduplicated within each backfill window only")
+
+        loaded, failed = 0, []
+        batches = defaultdict(int)
+        now = datetime.now(timezone.utc)
+        downloads = client.download_batches(
+            [files for _, files in plan], FILES_TEMP_DIR, prefetch=backfill.parallel_windows
+        )
+        try:
+            for (window_start, window_end), files in plan:
+                label = f"{window_start:%Y-%m-%d %H:%M} - {window_end:%Y-%m-%d %H:%M}"
+                if deadline and time.monotonic() > deadline:
+                    logging.warning(f"Backfill runtime limit reached, windows from {label} are left to the next run")
+                    break
+                with self.metrics.stage("download"):
+                    results = next(downloads)
+                try:
+                    quarantined = self._check_download_results(results)
+                except UserException as e:
+                    logging.warning(f"Window {label} is left to the next run: {e}")
+                    self._remove_files([r.path for r in results if r.path])
+                    failed.append(label)
+                    continue
+                self.metrics.add(
+                    "download",
+                    files=len(results),
+                    bytes=sum(r.size for r in results),
+                    worker_seconds=sum(r.seconds for r in results),
+                )
 
-        client = AdformClient(self.token, setup_id)
+                for prefix in datasets:
+                    prefix_files = [f for f in files if f["name"].startswith(prefix) and f["id"] not in quarantined]
+                    if prefix_files:
+                        logging.info(f"Processing dataset: {prefix}, window {label}")
+                        self.save_to_table(
+                            prefix, prefix_files, file_charset, custom_pkeys, True, batches[prefix], last_batch=False
+                        )
+                        batches[prefix] += 1
+                self._remove_files([r.path for r in results if r.path])
+                loaded += 1
+                # files may still be created in a window which has not ended yet
+                if window_end <= now:
+                    checkpoint["completed"].append(window_start.strftime(ADFORM_DATE_FORMAT))
+        finally:
+            downloads.close()
+        self.finalize_outputs()
+
+        if failed and not loaded:
+            raise UserException(f"None of the backfill windows could be loaded: {', '.join(failed)}")
+        remaining = len(pending) - loaded
+        logging.info(f"Backfill: {loaded} windows loaded, {remaining} windows left to the next run")
 
+    @staticmethod
+    def _parse_backfill_range(backfill: Backfill) -> tuple[datetime, datetime]:
         try:
-            files = client.retrieve_file_list()
+            start_date, end_date = (
+                datetime.strptime(d, "%d-%m-%Y %H:%M").replace(tzinfo=timezone.utc)
+                for d in (backfill.date_from, backfill.date_to)
+            )
+        except ValueError as e:
+            raise UserException(f"Invalid backfill date, expected format dd-mm-yyyy hh:mm: {e}")
+        if start_date >= end_date:
+            raise UserException("Backfill date_from must be before date_to")
+        return start_date, end_date
+
+    def _backfill_checkpoint(self, backfill: Backfill, start_date: datetime, end_date: datetime) -> dict:
+        """
+        Returns the backfill record kept in the state, it is started over when the range or windows change.
+
+        :return: {"date_from": str, "date_to": str, "window_hours": int, "completed": [window start]}
+        """
+        key = {
+            "date_from": start_date.strftime(ADFORM_DATE_FORMAT),
+            "date_to": end_date.strftime(ADFORM_DATE_FORMAT),
+            "window_hours": backfill.window_hours,
+        }
+        checkpoint = self.state.get(STATE_BACKFILL, {})
+        if {name: checkpoint.get(name) for name in key} != key:
+            if checkpoint:
+                logging.info("Backfill range has changed, it is loaded from the beginning")
+            checkpoint = {**key, "completed": []}
+        self.state[STATE_BACKFILL] = checkpoint
+        return checkpoint
+
+    @staticmethod
+    def split_into_windows(start_date: datetime, end_date: datetime, window_hours: int):
+        """
+        Splits the range into consecutive windows of window_hours, the last one ends at end_date.
+        """
+        step = timedelta(hours=window_hours)
+        windows = []
+        window_start = start_date
+        while window_start < end_date:
+            windows.append((window_start, min(window_start + step, end_date)))
+            window_start += step
+        return windows
 
+    @staticmethod
+    def assign_files_to_windows(files: list[dict], windows: list[tuple]) -> dict:
+        """
+        Returns files of each window keyed by the window start. A window contains files created from its start
+        until before its end, the last window contains also files created exactly at the end of the range.
+        """
+        starts = [window_start for window_start, _ in windows]
+        window_files = {window_start: [] for window_start in starts}
+        for file in files:
+            created_at = datetime.strptime(file["createdAt"], ADFORM_DATE_FORMAT).replace(tzinfo=timezone.utc)
+            index = bisect_right(starts, created_at) - 1
+            if 0 <= index and created_at <= windows[index][1]:
+                window_files[starts[index]].append(file)
+        return window_files
+
+    def finalize_outputs(self) -> None:
+        """
+        Writes manifests of the outputs appended by batches, the rollups and quarantined rows,
+        once all of them are exported.
+        """
+        for prefix, (out_table, _) in self.batch_outputs.items():
+            if self._exports_dataset(prefix):
+                self.write_manifest(out_table)
+            self.write_rollups(prefix)
+            self.write_quarantine(prefix)
+        self.batch_outputs.clear()
+        self.batch_columns.clear()
+
+    def list_files(self, client: AdformClient, start: datetime, end: datetime, datasets: list[str]) -> list[dict]:
+        """
+        Returns files of the datasets created within the interval including its end, ordered by dataset
+        and createdAt. The whole file list is read on every run, so files published late are loaded as well.
+        """
+        catalogue = FileCatalogue(client.setup_id, datasets)
+        try:
+            with self.metrics.stage("listing") as listing:
+                listed = list(client.retrieve_file_list(start, end, datasets))
+                catalogue.update(listed)
+                files = catalogue.select(start, end, datasets)
+                listing.counters["listed"] = len(listed)
+                listing.counters["files"] = len(files)
         except requests.exceptions.RequestException as e:
             raise UserException(f"Failed to retrieve file list: {str(e)}")
 
-        start_interval, end_interval = self._calculate_start_interval(date_to, days_interval, hours_interval)
-        filtered_files = self.filter_files_by_date_and_dataset(files, start_interval, end_interval, datasets)
+        # file catalogue stored in the state by previous versions is not used any more
+        self.state.pop(STATE_FILE_CATALOGUE, None)
+        return files
 
-        for file in filtered_files:
-            try:
-                client.download_file(file, FILES_TEMP_DIR)
-            except requests.exceptions.RequestException as e:
-                raise UserException(f"Failed to download file: {str(e)}")
+    def write_metrics(self) -> None:
+        """
+        Logs summary of the run metrics and stores them as a JSON file in the output files.
+        """
+        self.metrics.close()
+        summary = self.metrics.summary()
+        self.metrics.log_summary(summary)
+        out_file = self.create_out_file_definition(METRICS_FILE_NAME, tags=METRICS_FILE_TAGS)
+        os.makedirs(os.path.dirname(out_file.full_path), exist_ok=True)
+        RunMetrics.write(summary, out_file.full_path)
+        self.write_manifest(out_file)
+
+    def _check_download_results(self, results) -> set[str]:
+        """
+        Raises UserException if some of the files failed to download. Files which are still corrupted
+        or truncated after the retries are quarantined instead, they are left out of the load and their ids
+        are returned.
+        """
+        corrupted = [r for r in results if isinstance(r.error, DownloadVerificationError)]
+        failed = [r for r in results if r.error and not isinstance(r.error, DownloadVerificationError)]
+        if failed:
+            errors = "; ".join(f"{r.file['name']}: {str(r.error)}" for r in failed)
+            raise UserException(f"Failed to download {len(failed)} of {len(results)} files: {errors}")
+        for result in corrupted:
+            logging.warning(f"Quarantined file is not loaded: {result.error}")
+            self.quarantined_files[result.file["id"]] = result.file
+        if corrupted:
+            self.metrics.add("download", quarantined=len(corrupted))
+        return {r.file["id"] for r in corrupted}
 
-        for prefix in datasets:
-            downloaded_files = [f for f in filtered_files if f["name"].startswith(prefix)]
-            if downloaded_files:
-                logging.info(f"Processing dataset: {prefix}")
-                self.save_to_table(prefix, downloaded_files, file_charset, custom_pkeys, incremental)
+    @staticmethod
+    def _remove_files(paths: list[str]) -> None:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def plan_batches(
+        self, client: AdformClient, dataset_files: dict, file_charset: str, disk_budget_mb: Optional[int]
+    ) -> list[tuple[str, int, int, list[dict]]]:
+        """
+        Splits the files of each dataset into batches fitting the disk budget and returns
+        (dataset, batch index, batch count, files) for all batches in the processing order.
 
-        if meta_files:
-            client.download_file({"id": "meta__zip", "name": "meta.zip", "setup": setup_id}, FILES_TEMP_DIR)
-            self.unzip_file(f"{FILES_TEMP_DIR}/meta.zip", os.path.join(FILES_TEMP_DIR, "meta"))
-            for dim in meta_files:
-                logging.info(f"Processing meta file: {dim}")
-                self.save_metadata_to_table(dim)
-        print("Component finished successfully")
+        One batch is downloaded while the previous one is processed and non UTF-8 files are transcoded
+        into a copy, so each batch gets a half (or third) of the budget. Columns of datasets processed in
+        more batches are read from the file headers in advance, all the batches are exported with them.
+        """
+        plan = []
+        for prefix, prefix_files in dataset_files.items():
+            batches = [prefix_files]
+            if disk_budget_mb:
+                copies = 2 if file_charset in UTF8_COMPATIBLE_CHARSETS else 3
+                batches = self.split_into_batches(prefix_files, disk_budget_mb * 1024 * 1024 // copies)
+            if len(batches) > 1:
+                logging.info(f"Dataset {prefix} will be processed in {len(batches)} batches")
+                if self.deduplicate:
+                    logging.warning(f"Rows of dataset {prefix} are deduplicated within each batch only")
+                self.batch_columns[prefix] = self.probe_dataset_columns(client, prefix, prefix_files, file_charset)
+            plan += [(prefix, index, len(batches), batch) for index, batch in enumerate(batches)]
+        return plan
 
-    def save_to_table(self, prefix, downloaded_files, file_charset, custom_pkeys, incremental):
-        if file_charset == "UTF-8":  # if using UTF-8 we can load directly to DuckDB which handles gzip
-            self.duck.execute(f"""
-                CREATE VIEW {prefix} AS
-                SELECT * FROM read_csv(
-                    '{FILES_TEMP_DIR}/{prefix}_*.csv.gz',
-                    union_by_name=true,
-                    all_varchar=true
-                )
-            """)
+    @staticmethod
+    def split_into_batches(files: list[dict], budget_bytes: int) -> list[list[dict]]:
+        """
+        Splits the files keeping their order into batches whose total size does not exceed the budget,
+        a batch contains at least one file. Unknown file sizes are estimated by the average size.
+        """
+        sizes = [int(f["size"]) for f in files if f.get("size")]
+        if not sizes:
+            logging.warning("File sizes are not known, the files are processed in a single batch")
+            return [files]
+        average_size = sum(sizes) // len(sizes)
 
-        else:  # if not UTF-8 we need to first ungzip and convert to UTF-8 and then pass to DuckDB
+        batches, batch, batch_size = [], [], 0
+        for file in files:
+            size = int(file.get("size") or average_size)
+            if batch and batch_size + size > budget_bytes:
+                batches.append(batch)
+                batch, batch_size = [], 0
+            batch.append(file)
+            batch_size += size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def probe_dataset_columns(self, client: AdformClient, prefix: str, files: list[dict], file_charset: str) -> list:
+        """
+        Returns union of the columns of all the dataset files, read from the first line of each file
+        without downloading it whole. Columns cached in the state keep their order.
+        """
+        cached = self.state.get(STATE_DATASET_COLUMNS, {}).get(prefix, {})
+        dialect = CsvDialect(**cached["dialect"]) if cached.get("dialect") else CsvDialect()
+        codec = "utf-8" if file_charset in UTF8_COMPATIBLE_CHARSETS else CHARSET_CODECS.get(file_charset, file_charset)
+
+        with self.metrics.stage("headers", prefix):
+            try:
+                heads = client.read_file_heads(files)
+            except requests.exceptions.RequestException as e:
+                raise UserException(f"Failed to read headers of dataset {prefix} files: {e}")
+
+        columns = list(cached.get("columns", []))
+        present = set()
+        for file, head in zip(files, heads):
+            try:
+                # the head may end in the middle of a multi-byte character
+                lines = codecs.getincrementaldecoder(codec)(errors="strict").decode(head).splitlines()
+            except (UnicodeDecodeError, LookupError) as e:
+                raise UserException(f"Failed to read header of {file['name']} as {file_charset}: {e}")
+            header = parse_header(lines[0], dialect) if lines else []
+            present.update(header)
+            columns += [c for c in header if c not in columns]
+        return [c for c in columns if c in present]
+
+    def save_to_table(
+        self, prefix, downloaded_files, file_charset, custom_pkeys, incremental, batch=0, last_batch=True
+    ):
+        """
+        Loads the downloaded files of the dataset into the output table.
+
+        Datasets processed in more batches are appended to the output created by the first batch,
+        the manifest is written after the last one.
+        """
+        source_dir = FILES_TEMP_DIR  # if using UTF-8 we can load directly to DuckDB which handles gzip
+        transcoded = []
+        if file_charset not in UTF8_COMPATIBLE_CHARSETS:  # otherwise the files are converted to UTF-8 first
             to_process = [f["name"] for f in downloaded_files if f["name"].startswith(prefix)]
-            unzipped = self.ungzip_convert_to_utf8(to_process, file_charset, FILES_TEMP_DIR)
-            self.duck.execute(f"""
-                CREATE VIEW {prefix} AS
-                SELECT * FROM read_csv(
-                    '{unzipped}/{prefix}_*.csv.gz',
-                    union_by_name=true,
-                    all_varchar=true
+            with self.metrics.stage("transcode", prefix) as transcode:
+                transcoded = self.transcode_to_utf8(
+                    to_process, file_charset, FILES_TEMP_DIR, TRANSCODED_DIR, self.resource_limits.cpus
                 )
-            """)
+                transcode.counters["files"] = len(transcoded)
+                transcode.counters["bytes"] = sum(os.path.getsize(p) for p in transcoded)
+            source_dir = TRANSCODED_DIR
+
+        with self.metrics.stage("ingest", prefix):
+            pattern = f"{prefix}_*.csv.gz"
+            paths = [os.path.join(source_dir, f["name"]) for f in downloaded_files if fnmatch(f["name"], pattern)]
+            self.scans[prefix] = self.plan_scan(prefix, paths)
+            if prefix in self.batch_columns:
+                self.scans[prefix] = self._align_batch_scan(prefix, self.scans[prefix])
+            self.duck.execute(f"CREATE VIEW {prefix} AS SELECT * FROM {self._read_csv_sql(source_dir, prefix)}")
+
+            table_meta = self.duck.execute(f"""DESCRIBE {prefix};""").fetchall()
+            if prefix in self.dataset_selection:
+                table_meta = self.apply_selection(prefix, source_dir, table_meta)
+            if self.typed_output:
+                column_types = self.infer_column_types(prefix, [c[0] for c in table_meta])
+                table_meta = [(column, column_types[column]) for column, *_ in table_meta]
+        if prefix in self.batch_outputs:
+            out_table, primary_key = self.batch_outputs[prefix]
+        else:
+            out_table, primary_key = self._create_dataset_table(prefix, table_meta, custom_pkeys, incremental)
+
+        export_relation = prefix
+        if self.deduplicate and not primary_key:
+            logging.warning(f"Dataset {prefix} has no primary key, rows can not be deduplicated")
+        elif self.deduplicate:
+            columns = [c[0] for c in table_meta]
+            export_relation = self.deduplicate_rows(prefix, source_dir, primary_key, downloaded_files, columns)
+
+        output_relation = export_relation
+        try:
+            if self.typed_output:
+                output_relation = self.apply_column_types(prefix, export_relation, column_types, incremental)
+            if prefix in self.rollups:
+                self.aggregate_rollups(prefix, output_relation, table_meta, incremental)
+            if self._exports_dataset(prefix):
+                self.copy_to_output(output_relation, out_table, prefix, batch=batch)
+        except self._duckdb().ConversionException as e:
+            raise UserException(f"Error during query execution: {e}")
 
-        table_meta = self.duck.execute(f"""DESCRIBE {prefix};""").fetchall()
-        schema = OrderedDict(
+        if last_batch:
+            if self._exports_dataset(prefix):
+                self.write_manifest(out_table)
+            self.write_rollups(prefix)
+            self.write_quarantine(prefix)
+            self.batch_outputs.pop(prefix, None)
+            self.batch_columns.pop(prefix, None)
+        else:
+            self.batch_outputs[prefix] = (out_table, primary_key)
+        if output_relation != export_relation:
+            self.duck.execute(f"DROP VIEW {output_relation};")
+        if export_relation != prefix:
+            self.duck.execute(f"DROP VIEW {export_relation};")
+            self.duck.execute(f"DROP TABLE {export_relation}_rows;")
+            self.duck.execute(f"DROP TABLE {prefix}_files;")
+        self.duck.execute(f"DROP VIEW {prefix};")
+        self.scans.pop(prefix, None)
+        self.selections.pop(prefix, None)
+        self._remove_files(transcoded)
+
+    def infer_column_types(self, prefix: str, columns: list[str]) -> dict[str, str]:
+        """
+        Returns DuckDB types of the dataset columns for the typed output. The types are inferred from a sample
+        of the rows once and cached in the state, the following runs infer only the columns not seen before.
+        Columns without values in the sample are output as VARCHAR and inferred again by the next run.
+        """
+        cached = self.state.setdefault(STATE_DATASET_COLUMNS, {}).setdefault(prefix, {}).setdefault("types", {})
+        missing = [c for c in columns if c not in cached]
+        if missing:
+            with self.metrics.stage("infer_types", prefix):
+                counts = self.duck.execute(infer_types_sql(prefix, missing, TYPE_SAMPLE_ROWS)).fetchone()
+            inferred = pick_types(missing, counts)
+            logging.info(f"Types of dataset {prefix} columns: {', '.join(f'{c} {t}' for c, t in inferred.items())}")
+            empty = [c for c in missing if c not in inferred]
+            if empty:
+                logging.info(f"Columns of dataset {prefix} without values are loaded as strings: {', '.join(empty)}")
+            cached.update(inferred)
+        return {c: cached.get(c, "VARCHAR") for c in columns}
+
+    def apply_column_types(self, prefix: str, relation: str, column_types: dict, incremental: bool) -> str:
+        """
+        Returns name of the view with the values converted to the column types. Rows with a value which can not
+        be converted are not exported to the dataset table, they are appended to the {prefix}_quarantine table
+        with the original values instead.
+        """
+        if all(t == "VARCHAR" for t in column_types.values()):
+            return relation
+
+        if prefix in self.quarantine_outputs:
+            out_table, batches = self.quarantine_outputs[prefix]
+        else:
+            schema = self._table_schema([(c, "VARCHAR") for c in [*column_types, "quarantine_columns"]])
+            out_table = self.create_out_table_definition(
+                f"{prefix}_quarantine.csv", schema=schema, incremental=incremental, has_header=True
+            )
+            batches = 0
+        self.duck.execute(f"CREATE VIEW {prefix}_quarantined AS {quarantine_select_sql(relation, column_types)}")
+        rows = self.copy_to_output(f"{prefix}_quarantined", out_table, f"{prefix}_quarantine", batch=batches)
+        self.duck.execute(f"DROP VIEW {prefix}_quarantined")
+        if rows:
+            logging.warning(f"{rows} rows of dataset {prefix} with values not matching the column types quarantined")
+            batches += 1
+        elif not batches:
+            os.remove(out_table.full_path)
+        self.quarantine_outputs[prefix] = (out_table, batches)
+
+        self.duck.execute(f"CREATE VIEW {prefix}_typed AS {typed_select_sql(relation, column_types)}")
+        return f"{prefix}_typed"
+
+    def write_quarantine(self, prefix: str) -> None:
+        out_table, batches = self.quarantine_outputs.pop(prefix, (None, 0))
+        if batches:
+            self.write_manifest(out_table)
+
+    def _table_schema(self, table_meta: list) -> OrderedDict:
+        return OrderedDict(
             {c[0]: ColumnDefinition(data_types=BaseType(dtype=self.convert_base_types(c[1]))) for c in table_meta}
         )
 
+    def _exports_dataset(self, prefix: str) -> bool:
+        return not (self.rollups_only and prefix in self.rollups)
+
+    def aggregate_rollups(self, prefix: str, relation: str, table_meta: list, incremental: bool) -> None:
+        """
+        Aggregates the rollups of the dataset from the relation and accumulates the partial results
+        of the batches in DuckDB tables, until the rollups are written by write_rollups.
+        """
+        rollups = self.rollups[prefix]
+        available = {c[0] for c in table_meta}
+        for rollup in rollups:
+            missing = [c for c in rollup_columns(rollup) if c not in available]
+            if missing:
+                raise UserException(f"Rollup {rollup.name} columns {', '.join(missing)} not found in dataset {prefix}")
+
+        query = RollupQuery(rollups)
+        aggregate_table = f"{prefix}_rollups"
+        with self.metrics.stage("rollup", prefix) as stage:
+            self.duck.execute(f"CREATE TEMP TABLE {aggregate_table} AS {query.aggregate_sql(relation)}")
+            for rollup in rollups:
+                table = quote_identifier(f"rollup_{rollup.name}")
+                if rollup.name in self.rollup_tables:
+                    self.duck.execute(f"INSERT INTO {table} {query.select_sql(aggregate_table, rollup)}")
+                else:
+                    self.duck.execute(f"CREATE TEMP TABLE {table} AS {query.select_sql(aggregate_table, rollup)}")
+                    self.rollup_tables[rollup.name] = (table, incremental)
+            stage.counters["rows"] += self.duck.execute(f"SELECT count(*) FROM {aggregate_table}").fetchone()[0]
+            self.duck.execute(f"DROP TABLE {aggregate_table}")
+
+    def write_rollups(self, prefix: str) -> None:
+        """
+        Merges the partial results of the dataset rollups and exports them to output tables.
+
+        The rollups have no primary key, in incremental load the rows of a time bucket loaded by more runs
+        are appended and the consumers sum them up again.
+        """
+        for rollup in self.rollups.get(prefix, []):
+            if rollup.name not in self.rollup_tables:
+                continue
+            table, incremental = self.rollup_tables.pop(rollup.name)
+            view = quote_identifier(f"rollup_{rollup.name}_merged")
+            self.duck.execute(f"CREATE VIEW {view} AS {merge_sql(table, rollup)}")
+            table_meta = self.duck.execute(f"DESCRIBE {view}").fetchall()
+            out_table = self.create_out_table_definition(
+                f"{rollup.name}.csv", schema=self._table_schema(table_meta), incremental=incremental, has_header=True
+            )
+            self.copy_to_output(view, out_table, rollup.name)
+            self.write_manifest(out_table)
+            self.duck.execute(f"DROP VIEW {view}")
+            self.duck.execute(f"DROP TABLE {table}")
+
+    def _create_dataset_table(self, prefix: str, table_meta: list, custom_pkeys, incremental):
+        schema = self._table_schema(table_meta)
+
         primary_key = None
         if custom_pkeys:
             primary_key = [key for item in custom_pkeys if item.dataset == prefix for key in item.pkey]
         elif schema.get("GUID"):
             primary_key = ["GUID"]
+        missing_keys = [key for key in primary_key or [] if key not in schema]
+        if missing_keys:
+            raise UserException(f"Primary key columns {', '.join(missing_keys)} not found in dataset {prefix}")
 
         out_table = self.create_out_table_definition(
-            f"{prefix}.csv", schema=schema, primary_key=primary_key, incremental=incremental, has_header=True
+            f"{prefix}.csv",
+            schema=schema,
+            primary_key=primary_key,
+            incremental=incremental,
+            is_sliced=self.slice_size_mb is not None,
+            has_header=self.slice_size_mb is None,
         )
 
+        return out_table, primary_key
+
+    def _align_batch_scan(self, prefix: str, scan: Optional[CsvScan]) -> CsvScan:
+        # all batches are exported with the columns read in advance, columns missing in a batch are NULL
+        if scan is None:
+            raise UserException(f"Unable to read headers of dataset {prefix} files, it can not be processed in batches")
+        unexpected = [c for c in scan.columns if c not in self.batch_columns[prefix]]
+        if unexpected:
+            raise UserException(
+                f"Columns {', '.join(unexpected)} of dataset {prefix} were not in the file headers read in advance"
+            )
+        scan.columns = list(self.batch_columns[prefix])
+        return scan
+
+    def plan_scan(self, prefix: str, paths: list[str]) -> Optional[CsvScan]:
+        """
+        Builds the explicit scan of the dataset files from their header lines, so DuckDB does not have to sniff
+        every file. Columns and CSV dialect of the dataset are cached in the state, columns not seen before
+        are appended to the cached ones.
+
+        Returns None if the headers can not be read, the files are then read with union_by_name.
+        """
+        cached = self.state.get(STATE_DATASET_COLUMNS, {}).get(prefix, {})
+        known_columns = cached.get("columns", [])
+        dialect = CsvDialect(**cached["dialect"]) if cached.get("dialect") else self.sniff_dialect(paths)
+
+        scan = CsvScan.from_files(paths, dialect, known_columns) if dialect else None
+        if scan is None:
+            logging.warning(f"Unable to read headers of dataset {prefix} files, columns will be detected by DuckDB")
+            return None
+
+        new_columns = scan.new_columns(known_columns)
+        if new_columns and known_columns:
+            logging.info(f"New columns in dataset {prefix}: {', '.join(new_columns)}")
+        self.state.setdefault(STATE_DATASET_COLUMNS, {})[prefix] = {
+            **cached,
+            "columns": known_columns + new_columns,
+            "dialect": dialect.to_dict(),
+        }
+        return scan
+
+    def sniff_dialect(self, paths: list[str]) -> Optional[CsvDialect]:
+        if not paths:
+            return None
         try:
-            self.duck.execute(f"COPY {prefix} TO '{out_table.full_path}' (HEADER, DELIMITER ',', FORCE_QUOTE *)")
-        except duckdb.duckdb.ConversionException as e:
-            raise UserException(f"Error during query execution: {e}")
+            delimiter, quote, escape = self.duck.execute(
+                "SELECT Delimiter, Quote, Escape FROM sniff_csv(?)", [paths[0]]
+            ).fetchone()
+        except self._duckdb().Error as e:
+            logging.warning(f"Unable to detect CSV dialect of {paths[0]}: {e}")
+            return None
+        # the sniffer reports no quote when the sample has no quoted values, later rows still may have them
+        default = CsvDialect()
+        return CsvDialect(
+            delimiter=delimiter,
+            quote=quote if quote and quote != "\0" else default.quote,
+            escape=escape if escape and escape != "\0" else default.escape,
+        )
+
+    def _read_csv_sql(self, source_dir: str, prefix: str, filename: bool = False) -> str:
+        if self.scans.get(prefix):
+            return self.scans[prefix].to_sql(filename)
+        return f"""read_csv(
+            '{source_dir}/{prefix}_*.csv.gz',
+            union_by_name=true,
+            all_varchar=true,
+            filename={str(filename).lower()}
+        )"""
+
+    def apply_selection(self, prefix: str, source_dir: str, table_meta: list) -> list:
+        """
+        Replaces the dataset view with one reading only the selected columns and the rows passing the filters
+        configured for the dataset. DuckDB pushes both into the CSV scan, so the rest is never materialised.
 
-        self.write_manifest(out_table)
+        Returns the description of the selected columns.
+        """
+        selection = self.dataset_selection[prefix]
+        available = [c[0] for c in table_meta]
+        missing = [f.column for f in selection.filters if f.column not in available]
+        if missing:
+            raise UserException(f"Filter columns {', '.join(missing)} not found in dataset {prefix}")
+
+        columns = available
+        if selection.columns:
+            missing = [c for c in selection.columns if c not in available]
+            if missing:
+                logging.warning(f"Selected columns {', '.join(missing)} not found in dataset {prefix}")
+            columns = [c for c in available if c in selection.columns]
+            if not columns:
+                raise UserException(f"None of the selected columns found in dataset {prefix}")
+
+        self.selections[prefix] = (columns, row_filter_sql(selection.filters))
+        self.duck.execute(f"CREATE OR REPLACE VIEW {prefix} AS SELECT * FROM {self._dataset_sql(source_dir, prefix)}")
+        return [c for c in table_meta if c[0] in columns]
+
+    def _dataset_sql(self, source_dir: str, prefix: str, filename: bool = False) -> str:
+        scan = self._read_csv_sql(source_dir, prefix, filename)
+        if prefix not in self.selections:
+            return scan
+        columns, condition = self.selections[prefix]
+        projection = ", ".join(quote_identifier(c) for c in columns) + (", filename" if filename else "")
+        return f"(SELECT {projection} FROM {scan} WHERE {condition})"
+
+    def deduplicate_rows(
+        self, prefix: str, source_dir: str, primary_key: list[str], downloaded_files, columns: list[str]
+    ) -> str:
+        """
+        Keeps a single row per primary key and returns name of the view with the deduplicated rows.
+
+        The row from the most recently created file wins. If dedup_order_by column is set, the row with its
+        highest value wins and the file creation time breaks ties. DuckDB spills the window to its temporary
+        directory when the memory limit is reached.
+        """
+        if self.dedup_order_by and self.dedup_order_by not in columns:
+            raise UserException(f"Deduplication order column {self.dedup_order_by} not found in dataset {prefix}")
 
-    def save_metadata_to_table(self, dim):
+        self.duck.execute(f"CREATE TEMP TABLE {prefix}_files (filename VARCHAR, created_at VARCHAR);")
+        self.duck.executemany(
+            f"INSERT INTO {prefix}_files VALUES (?, ?);",
+            [[os.path.join(source_dir, f["name"]), f["createdAt"]] for f in downloaded_files],
+        )
+
+        partition = ", ".join(f"r.{quote_identifier(column)}" for column in primary_key)
+        order = "f.created_at DESC, r.filename DESC"
+        if self.dedup_order_by:
+            order = f"r.{quote_identifier(self.dedup_order_by)} DESC NULLS LAST, {order}"
+
+        with self.metrics.stage("dedup", prefix) as dedup:
+            self.duck.execute(f"""
+                CREATE TEMP TABLE {prefix}_deduplicated_rows AS
+                SELECT r.* EXCLUDE (filename), count(*) OVER (PARTITION BY {partition}) AS __duplicates
+                FROM {self._dataset_sql(source_dir, prefix, filename=True)} r
+                JOIN {prefix}_files f ON r.filename = f.filename
+                QUALIFY row_number() OVER (PARTITION BY {partition} ORDER BY {order}) = 1
+            """)
+            dropped = self.duck.execute(
+                f"SELECT coalesce(sum(__duplicates) - count(*), 0) FROM {prefix}_deduplicated_rows;"
+            ).fetchone()[0]
+            dedup.counters["rows_dropped"] += dropped
+
+        logging.info(f"Removed {dropped} duplicate rows from dataset {prefix}")
+        self.duck.execute(f"""
+            CREATE VIEW {prefix}_deduplicated AS SELECT * EXCLUDE (__duplicates) FROM {prefix}_deduplicated_rows
+        """)
+        return f"{prefix}_deduplicated"
+
+    def process_meta_files(self, client: AdformClient, setup_id: str, meta_files: list[str], always_get_meta: bool):
+        """
+        Loads the requested dimensions from meta.zip.
+
+        Unless always_get_meta is set, unchanged meta.zip is skipped. ETag, Last-Modified and size of the archive
+        are compared with the state before the download, SHA-256 of its content after it. Dimensions not loaded
+        by the previous runs are loaded even if meta.zip has not changed.
+        """
+        meta_file = {"id": "meta__zip", "name": "meta.zip", "setup": setup_id}
+        previous = {} if always_get_meta else self.state.get(STATE_META_ZIP, {})
+        loaded = set(previous.get("dimensions", []))
+        fingerprint = {} if always_get_meta else client.get_file_fingerprint(meta_file)
+        if set(meta_files) <= loaded and self._same_fingerprint(fingerprint, previous):
+            logging.info("meta.zip has not changed since the last run, skipping metadata")
+            return
+
+        with self.metrics.stage("download", "meta") as download:
+            # meta.zip keeps its id while the content changes, it can not be served from the cache
+            path = client.download_file(meta_file, FILES_TEMP_DIR, use_cache=False)
+            download.counters["files"] = 1
+            download.counters["bytes"] = os.path.getsize(path)
+
+        digest = self._file_sha256(path)
+        if digest != previous.get("sha256"):
+            loaded = set()
+        dimensions = [dim for dim in meta_files if dim not in loaded]
+        if not dimensions:
+            logging.info("meta.zip content has not changed since the last run, skipping metadata")
+        loaded.update(self.save_metadata_tables(path, dimensions))
+        self._remove_files([path])
+        self.state[STATE_META_ZIP] = {**fingerprint, "sha256": digest, "dimensions": sorted(loaded)}
+
+    @staticmethod
+    def _same_fingerprint(current: dict, previous: dict) -> bool:
+        # size alone does not tell whether the content changed
+        if not current.get("etag") and not current.get("last_modified"):
+            return False
+        return all(current.get(key) == previous.get(key) for key in ("etag", "last_modified", "size"))
+
+    @staticmethod
+    def _file_sha256(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(TRANSCODE_CHUNK_SIZE):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def save_metadata_tables(self, zip_path: str, dimensions: list[str]) -> list[str]:
+        """
+        Loads the dimensions from meta.zip in parallel, each using its own DuckDB cursor.
+
+        Only the requested members are extracted. Returns the dimensions found in the archive.
+        """
+        with zipfile.ZipFile(zip_path) as zip_ref:
+            members = set(zip_ref.namelist())
+        found = []
+        for dim in dimensions:
+            if f"{dim}.json" in members:
+                found.append(dim)
+            else:
+                logging.error(f"Metadata file not found: {dim}.json")
+
+        workers = max(1, min(len(found), self.resource_limits.cpus))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda dim: self.save_metadata_to_table(dim, zip_path), found))
+        return found
+
+    def save_metadata_to_table(self, dim, zip_path):
+        logging.info(f"Processing meta file: {dim}")
+        duck = self.duck.cursor()
+        json_path = None
         try:
             table_name = dim.replace("-", "_")
-            self.duck.execute(f"CREATE TABLE {table_name} AS SELECT * FROM '{FILES_TEMP_DIR}/meta/{dim}.json'")
+            with self.metrics.stage("ingest", f"meta-{dim}"):
+                json_path = self.extract_member(zip_path, f"{dim}.json", META_DIR)
+                duck.execute(f"CREATE TABLE {table_name} AS SELECT * FROM '{json_path}'")
 
-            table_meta = self.duck.execute(f"""DESCRIBE {table_name};""").fetchall()
+            if dim == "banners-adgroups":
+                # if table doesn't contain deleted column, create it and keep it null
+                columns = [c[0] for c in duck.execute(f"DESCRIBE {table_name};").fetchall()]
+                if "deleted" not in columns:
+                    logging.info(f"Adding 'deleted' column to meta-{dim} table")
+                    duck.execute(f"ALTER TABLE {table_name} ADD COLUMN deleted VARCHAR;")
+
+            table_meta = duck.execute(f"""DESCRIBE {table_name};""").fetchall()
             schema = OrderedDict(
                 {c[0]: ColumnDefinition(data_types=BaseType(dtype=self.convert_base_types(c[1]))) for c in table_meta}
             )
@@ -140,52 +990,126 @@ class Component(ComponentBase):
             primary_key = ["id"] if schema.get("id") else None
 
             out_table = self.create_out_table_definition(
-                f"meta-{dim}.csv", schema=schema, primary_key=primary_key, has_header=True
+                f"meta-{dim}.csv",
+                schema=schema,
+                primary_key=primary_key,
+                is_sliced=self.slice_size_mb is not None,
+                has_header=self.slice_size_mb is None,
             )
 
-            if dim == "banners-adgroups":
-                # if table doesn't contain deleted column, create it and keep it null
-                if "deleted" not in schema:
-                    logging.info(f"Adding 'deleted' column to meta-{dim} table")
-                    self.duck.execute(f"ALTER TABLE {table_name} ADD COLUMN deleted VARCHAR;")
-
-            self.duck.execute(f"COPY {table_name} TO '{out_table.full_path}' (HEADER, DELIMITER ',', FORCE_QUOTE *)")
+            self.copy_to_output(table_name, out_table, f"meta-{dim}", duck)
 
             self.write_manifest(out_table)
-            self.duck.execute(f"DROP TABLE {table_name};")
+            duck.execute(f"DROP TABLE {table_name};")
 
-        except duckdb.duckdb.IOException as e:
+        except self._duckdb().IOException as e:
             logging.error(f"Metadata file not found: {e}")
         except Exception as e:
             raise UserException(f"Error during processing metadata file: {e}")
+        finally:
+            duck.close()
+            if json_path:
+                self._remove_files([json_path])
+
+    def copy_to_output(
+        self, table_name: str, out_table, dataset: str, duck: "DuckDBPyConnection" = None, batch: int = 0
+    ) -> int:
+        """
+        Exports the table or view to the output table file and returns the number of exported rows.
+        The connection defaults to the component one, a cursor is passed when called from a worker thread.
+
+        Sliced output is a folder of gzipped CSV slices without header written by all DuckDB threads,
+        values are quoted only when needed. Otherwise a single CSV with header and all values quoted is written.
+        Batches following the first one add slices to the folder or are appended to the CSV without header.
+        """
+        duck = duck or self.duck
+        with self.metrics.stage("export", dataset) as export:
+            if out_table.is_sliced:
+                previous_bytes = directory_size(out_table.full_path)
+                naming = f"FILENAME_PATTERN 'batch{batch}_{{i}}', OVERWRITE_OR_IGNORE true," if batch else ""
+                result = duck.execute(f"""
+                    COPY {table_name} TO '{out_table.full_path}' (
+                        FORMAT CSV,
+                        HEADER false,
+                        DELIMITER ',',
+                        COMPRESSION gzip,
+                        PER_THREAD_OUTPUT true,
+                        {naming}
+                        FILE_SIZE_BYTES '{self.slice_size_mb}MB',
+                        FILE_EXTENSION 'csv.gz'
+                    )
+                """)
+                output_bytes = directory_size(out_table.full_path) - previous_bytes
+            elif batch:
+                batch_path = f"{out_table.full_path}.batch"
+                result = duck.execute(
+                    f"COPY {table_name} TO '{batch_path}' (HEADER false, DELIMITER ',', FORCE_QUOTE *)"
+                )
+                output_bytes = os.path.getsize(batch_path)
+                with open(batch_path, "rb") as src, open(out_table.full_path, "ab") as dst:
+                    shutil.copyfileobj(src, dst, TRANSCODE_CHUNK_SIZE)
+                os.remove(batch_path)
+            else:
+                result = duck.execute(
+                    f"COPY {table_name} TO '{out_table.full_path}' (HEADER, DELIMITER ',', FORCE_QUOTE *)"
+                )
+                output_bytes = os.path.getsize(out_table.full_path)
+
+            rows = result.fetchone()[0]
+            export.counters["rows"] += rows
+            export.counters["bytes"] += output_bytes
+        return rows
 
     @staticmethod
-    def ungzip_convert_to_utf8(in_files: list[str], source_encoding: str, input_dir: str) -> str:
-        ungzipped_dir = os.path.join(input_dir, "unzipped")
-        os.makedirs(ungzipped_dir, exist_ok=True)
-
-        for filename in in_files:
-            input_path = os.path.join(input_dir, filename)
-            output_filename = filename[:-3] if filename.endswith(".gz") else filename
-            output_path = os.path.join(ungzipped_dir, output_filename)
-
-            if filename.endswith(".gz"):
-                with (
-                    gzip.open(input_path, "rt", encoding=source_encoding) as f_in,
-                    open(output_path, "w", encoding="utf-8") as f_out,
-                ):
-                    while True:
-                        chunk = f_in.read(1024 * 1024)
-                        if not chunk:
-                            break
-                        f_out.write(chunk)
-
-        return ungzipped_dir
+    def transcode_to_utf8(
+        in_files: list[str], source_encoding: str, input_dir: str, output_dir: str, max_workers: int = None
+    ) -> list[str]:
+        """
+        Converts gzipped files from source_encoding to UTF-8, each file in a separate process.
+
+        The output is gzipped again with a fast compression level, so DuckDB reads it directly
+        and it does not take more disk space than the downloaded files.
+
+        :return: paths of the converted files
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        codec = CHARSET_CODECS.get(source_encoding, source_encoding)
+        input_paths = [os.path.join(input_dir, f) for f in in_files]
+        output_paths = [os.path.join(output_dir, f) for f in in_files]
+
+        workers = min(len(in_files), max_workers or os.cpu_count() or 1)
+        try:
+            if workers <= 1:
+                return [Component._transcode_file(i, o, codec) for i, o in zip(input_paths, output_paths)]
+            # spawn, because forking while the download threads are running is not safe
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+                return list(pool.map(Component._transcode_file, input_paths, output_paths, [codec] * len(in_files)))
+        except (UnicodeDecodeError, LookupError) as e:
+            raise UserException(f"Failed to convert files from {source_encoding} to UTF-8: {e}") from e
 
     @staticmethod
-    def unzip_file(zip_path, extract_path):
-        with zipfile.ZipFile(zip_path) as zip_ref:
-            zip_ref.extractall(extract_path)
+    def _transcode_file(input_path: str, output_path: str, codec: str) -> str:
+        # incremental decoder keeps multi-byte characters split between chunks
+        decoder = codecs.getincrementaldecoder(codec)()
+        with (
+            gzip.open(input_path, "rb") as f_in,
+            gzip.open(output_path, "wb", compresslevel=TRANSCODE_COMPRESS_LEVEL) as f_out,
+        ):
+            while chunk := f_in.read(TRANSCODE_CHUNK_SIZE):
+                f_out.write(decoder.decode(chunk).encode("utf-8"))
+            f_out.write(decoder.decode(b"", final=True).encode("utf-8"))
+        return output_path
+
+    @staticmethod
+    def extract_member(zip_path: str, member: str, output_dir: str) -> str:
+        """
+        Streams a single member of the archive into output_dir and returns its path.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        path = os.path.join(output_dir, os.path.basename(member))
+        with zipfile.ZipFile(zip_path) as zip_ref, zip_ref.open(member) as src, open(path, "wb") as dst:
+            shutil.copyfileobj(src, dst, TRANSCODE_CHUNK_SIZE)
+        return path
 
     @staticmethod
     def convert_base_types(dtype: str) -> SupportedDataTypes:
@@ -229,7 +1153,7 @@ class Component(ComponentBase):
             client_id = self.credentials["app_key"]
             client_secret = self.credentials["#app_secret"]
 
-        state_file = self.get_state_file()
+        state_file = self.state
 
         state_file_refresh_token = state_file.get(STATE_REFRESH_TOKEN, [])
         state_file_auth_id = state_file.get(STATE_AUTH_ID, [])
@@ -285,36 +1209,54 @@ class Component(ComponentBase):
         - To data/out/state.json via the component library (used by KBC when the job is successful)
         - Via the Storage API (for cases when the job fails)
 
+        The Storage API calls run in a background thread, so the file listing does not wait for them.
+        execute_action waits for the thread before the component exits.
+
         :param refresh_token: The new refresh token to be saved
         :return: None
         """
-        self.write_state_file({STATE_AUTH_ID: self.credentials.get("id", ""), STATE_REFRESH_TOKEN: refresh_token})
+        self.state[STATE_AUTH_ID] = self.credentials.get("id", "")
+        self.state[STATE_REFRESH_TOKEN] = refresh_token
+        self.write_state_file(self.state)
         if self.environment_variables.stack_id:
-            logging.debug("Saving new refresh token to state using Keboola API.")
-            try:
-                encrypted_refresh_token = self.encrypt(refresh_token)
-            except requests.exceptions.RequestException:
-                logging.warning("Encrypt API is unavailable. Skipping token save at the beginning of the run.")
-                return
-
-            new_state = {
-                "component": {
-                    STATE_AUTH_ID: self.credentials.get("id", ""),
-                    STATE_REFRESH_TOKEN: encrypted_refresh_token
-                }
-            }
-            try:
-                self.update_config_state_api(
-                    component_id=self.environment_variables.component_id,
-                    configurationId=self.environment_variables.config_id,
-                    state=new_state,
-                    branch_id=self.environment_variables.branch_id,
-                )
-            except requests.exceptions.RequestException:
-                logging.warning(
-                    "Storage API (update config state)is unavailable. Skipping token save at the beginning of the run."
-                )
-                return
+            # the state keeps changing during the run, the thread gets a copy of it
+            state = copy.deepcopy(self.state)
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="token-persistence")
+            self._token_persistence = executor.submit(self._persist_token, refresh_token, state)
+            executor.shutdown(wait=False)
+
+    def _persist_token(self, refresh_token: str, state: dict) -> None:
+        logging.debug("Saving new refresh token to state using Keboola API.")
+        try:
+            encrypted_refresh_token = self.encrypt(refresh_token)
+        except requests.exceptions.RequestException:
+            logging.warning("Encrypt API is unavailable. Skipping token save at the beginning of the run.")
+            return
+
+        # the rest of the state is kept, otherwise the processed files record would be lost if the job fails
+        new_state = {"component": {**state, STATE_REFRESH_TOKEN: encrypted_refresh_token}}
+        try:
+            self.update_config_state_api(
+                component_id=self.environment_variables.component_id,
+                configurationId=self.environment_variables.config_id,
+                state=new_state,
+                branch_id=self.environment_variables.branch_id,
+            )
+        except requests.exceptions.RequestException:
+            logging.warning(
+                "Storage API (update config state)is unavailable. Skipping token save at the beginning of the run."
+            )
+
+    def wait_for_token_persistence(self) -> None:
+        """
+        Waits until the new refresh token is saved via the Storage API, errors of the thread are raised here.
+        """
+        if self._token_persistence is None:
+            return
+        future, self._token_persistence = self._token_persistence, None
+        if not future.done():
+            logging.info("Waiting for the refresh token to be saved")
+        future.result()
 
     def _get_storage_token(self) -> str:
         token = self.configuration.parameters.get("#storage_token") or self.environment_variables.token
@@ -354,13 +1296,39 @@ class Component(ComponentBase):
         response.raise_for_status()
 
     @staticmethod
-    def init_duckdb() -> DuckDBPyConnection:
+    def _duckdb():
+        import duckdb
+
+        return duckdb
+
+    @staticmethod
+    def init_duckdb(advanced: Advanced, limits: ResourceLimits) -> "DuckDBPyConnection":
         """
         Returns connection to temporary DuckDB database
+
+        Threads, memory and spill directory are derived from the container limits unless overridden
+        in the advanced parameters.
         """
-        os.makedirs(DUCK_DB_DIR, exist_ok=True)
         # TODO: On GCP consider changin tmp to /opt/tmp
-        config = dict(temp_directory=DUCK_DB_DIR, threads="1", max_memory=DUCK_DB_MAX_MEMORY)
+        temp_directory = advanced.duckdb_temp_directory or DUCK_DB_DIR
+        os.makedirs(temp_directory, exist_ok=True)
+        config = dict(
+            temp_directory=temp_directory,
+            threads=str(advanced.duckdb_threads or limits.cpus),
+            max_memory=advanced.duckdb_max_memory or duckdb_memory_limit(limits, DUCK_DB_MAX_MEMORY),
+        )
+        max_temp_directory_size = duckdb_temp_directory_limit(temp_directory)
+        if max_temp_directory_size:
+            config["max_temp_directory_size"] = max_temp_directory_size
+
+        memory_mb = limits.memory_bytes // 1024 // 1024 if limits.memory_bytes else "unknown"
+        logging.info(
+            f"Detected {limits.cpus} CPUs and {memory_mb} MB of memory, DuckDB configuration: "
+            + ", ".join(f"{key}={value}" for key, value in config.items())
+        )
+        # imported here, it takes a noticeable part of the startup and is not needed until the first ingest
+        import duckdb
+
         conn = duckdb.connect(config=config)
 
         return conn
@@ -375,15 +1343,37 @@ class Component(ComponentBase):
         return start_date, end_date
 
     @staticmethod
-    def filter_files_by_date_and_dataset(files, start_date, end_date, datasets):
-        filtered_files = []
-        for file in files:
-            file_date = datetime.strptime(file["createdAt"], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
-            if (end_date is None and start_date <= file_date) or (start_date <= file_date <= end_date):
-                if any(file["name"].startswith(prefix) for prefix in datasets):
-                    filtered_files.append(file)
+    def skip_processed_files(files: list[dict], processed_files: dict) -> list[dict]:
+        processed_ids = {file_id for record in processed_files.values() for file_id in record.get("files", {})}
+        filtered_files = [f for f in files if f["id"] not in processed_ids]
+        if len(filtered_files) < len(files):
+            logging.info(f"Skipping {len(files) - len(filtered_files)} files already ingested by previous runs")
         return filtered_files
 
+    @staticmethod
+    def update_processed_files(processed_files: dict, new_files: list[dict], datasets, retain_from: datetime) -> dict:
+        """
+        Adds the newly ingested files to the processed files record kept in the state.
+
+        The record holds the ids of ingested files with their createdAt and the highest createdAt per dataset.
+        Files created before retain_from (start of the current window) can not be selected again
+        by a following run, so they are pruned to keep the state small.
+
+        :return: {prefix: {"last_created_at": str, "files": {file_id: createdAt}}}
+        """
+        retain_from_str = retain_from.strftime(ADFORM_DATE_FORMAT)
+        updated = {}
+        for prefix in set(processed_files) | set(datasets):
+            record = processed_files.get(prefix, {})
+            ingested = dict(record.get("files", {}))
+            ingested.update({f["id"]: f["createdAt"] for f in new_files if f["name"].startswith(prefix)})
+            # createdAt is an ISO 8601 UTC string, so it can be compared lexicographically
+            ingested = {file_id: created for file_id, created in ingested.items() if created >= retain_from_str}
+            last_created_at = max([record.get("last_created_at", ""), *ingested.values()])
+            if ingested or last_created_at:
+                updated[prefix] = {"last_created_at": last_created_at, "files": ingested}
+        return updated
+
 
 """
         Main entrypoint
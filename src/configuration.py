@@ -1,7 +1,7 @@
 import logging
 from typing import List, Optional
 from enum import Enum
-from pydantic import BaseModel, Field, ValidationError, computed_field
+from pydantic import BaseModel, Field, ValidationError, computed_field, field_validator, model_validator
 from keboola.component.exceptions import UserException
 
 
@@ -15,6 +15,51 @@ class OverridePKeyItem(BaseModel):
     dataset: str = Field()
 
 
+class FilterOperator(str, Enum):
+    eq = "="
+    ne = "!="
+    gt = ">"
+    ge = ">="
+    lt = "<"
+    le = "<="
+    in_list = "in"
+    not_in_list = "not_in"
+
+
+class FilterDataType(str, Enum):
+    string = "string"
+    integer = "integer"
+    number = "number"
+    timestamp = "timestamp"
+
+
+class RowFilter(BaseModel):
+    column: str
+    operator: FilterOperator = Field(default=FilterOperator.eq)
+    values: List[str] = Field(min_length=1)
+    data_type: FilterDataType = Field(default=FilterDataType.string)
+
+    @model_validator(mode="after")
+    def check_values(self):
+        if self.operator not in (FilterOperator.in_list, FilterOperator.not_in_list) and len(self.values) != 1:
+            raise ValueError(f"Filter on {self.column} with operator {self.operator.value} requires a single value")
+        return self
+
+
+class DatasetSelection(BaseModel):
+    dataset: str
+    columns: Optional[List[str]] = Field(default=None)
+    filters: List[RowFilter] = Field(default_factory=list)
+
+
+class Backfill(BaseModel):
+    date_from: str
+    date_to: str
+    window_hours: int = Field(default=24, ge=1)
+    parallel_windows: int = Field(default=2, ge=1, le=8)
+    max_runtime_minutes: Optional[int] = Field(default=None, ge=1)
+
+
 class Source(BaseModel):
     setup_id: str
     days_interval: int
@@ -23,21 +68,104 @@ class Source(BaseModel):
     datasets: List[str] = Field(default=["Click", "Impression", "Trackingpoint", "Event"])
     file_charset: str = Field(default="UTF-8")
     meta_files: Optional[List[str]] = Field(default=None)
+    always_get_meta: bool = Field(default=True)
+    download_workers: int = Field(default=4, ge=1, le=32)
+    download_cache_dir: Optional[str] = Field(default=None)
+    dataset_selection: List[DatasetSelection] = Field(default_factory=list)
+    backfill: Optional[Backfill] = Field(default=None)
+
+    @field_validator("backfill", mode="before")
+    @classmethod
+    def drop_empty_backfill(cls, value):
+        # the UI form saves all the fields, a backfill without dates is not configured
+        if isinstance(value, dict) and not (value.get("date_from") or "").strip() \
+                and not (value.get("date_to") or "").strip():
+            return None
+        return value
+
+
+class RollupFunction(str, Enum):
+    count = "count"
+    sum = "sum"
+    min = "min"
+    max = "max"
+
+
+class TimeGrain(str, Enum):
+    hour = "hour"
+    day = "day"
+    week = "week"
+    month = "month"
+
+
+class RollupMeasure(BaseModel):
+    name: str
+    function: RollupFunction = Field(default=RollupFunction.count)
+    column: Optional[str] = Field(default=None)
+    data_type: FilterDataType = Field(default=FilterDataType.number)
+
+    @model_validator(mode="after")
+    def check_column(self):
+        if self.column is None and self.function != RollupFunction.count:
+            raise ValueError(f"Measure {self.name} with function {self.function.value} requires a column")
+        return self
+
+
+class Rollup(BaseModel):
+    name: str
+    dataset: str
+    dimensions: List[str] = Field(default_factory=list)
+    time_column: Optional[str] = Field(default=None)
+    time_grain: TimeGrain = Field(default=TimeGrain.hour)
+    measures: List[RollupMeasure] = Field(default_factory=lambda: [RollupMeasure(name="rows")])
+
+    @model_validator(mode="after")
+    def check_grouping(self):
+        if not self.dimensions and not self.time_column:
+            raise ValueError(f"Rollup {self.name} requires dimensions or a time column")
+        if not self.measures:
+            raise ValueError(f"Rollup {self.name} requires at least one measure")
+        names = self.dimensions + ([self.time_column] if self.time_column else []) + [m.name for m in self.measures]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Rollup {self.name} has duplicate column names")
+        return self
 
 
 class Destination(BaseModel):
     table_name: str = Field(default=None)
     load_type: LoadType = Field(default=LoadType.incremental_load)
     override_pkey: Optional[List[OverridePKeyItem]]
+    sliced_output: bool = Field(default=False)
+    slice_size_mb: int = Field(default=256, ge=1)
+    deduplicate: bool = Field(default=False)
+    dedup_order_by: Optional[str] = Field(default=None)
+    rollups: List[Rollup] = Field(default_factory=list)
+    rollups_only: bool = Field(default=False)
+    typed_output: bool = Field(default=False)
+
+    @model_validator(mode="after")
+    def check_rollup_names(self):
+        names = [rollup.name for rollup in self.rollups]
+        if len(set(names)) != len(names):
+            raise ValueError("Rollup names must be unique")
+        return self
 
     @computed_field
     def incremental(self) -> bool:
         return self.load_type == LoadType.incremental_load
 
 
+class Advanced(BaseModel):
+    duckdb_threads: Optional[int] = Field(default=None, ge=1)
+    duckdb_max_memory: Optional[str] = Field(default=None)
+    duckdb_temp_directory: Optional[str] = Field(default=None)
+    batch_disk_budget_mb: Optional[int] = Field(default=None, ge=1)
+
+
 class Configuration(BaseModel):
     source: Source
     destination: Destination
+    advanced: Advanced = Field(default_factory=Advanced)
     debug: bool = False
 
     def __init__(self, **data):
@@ -0,0 +1,215 @@
+import csv
+import gzip
+import zlib
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+
+@dataclass
+class CsvDialect:
+    delimiter: str = ","
+    quote: str = '"'
+    escape: str = '"'
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def quote_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def quote_identifier(value: str) -> str:
+    return '"' + value.replace('"', '""') + '"'
+
+
+# DuckDB types the values are compared as, the CSV columns themselves are read as VARCHAR
+FILTER_SQL_TYPES = {"integer": "BIGINT", "number": "DOUBLE", "timestamp": "TIMESTAMP"}
+
+
+def row_filter_sql(filters) -> str:
+    """
+    Returns SQL condition matching rows which pass all the filters (RowFilter from the configuration).
+
+    Typed filters compare TRY_CAST of the column, so rows with values not convertible to the type do not pass.
+    """
+    conditions = []
+    for row_filter in filters:
+        sql_type = FILTER_SQL_TYPES.get(row_filter.data_type.value)
+        column = quote_identifier(row_filter.column)
+        values = [quote_literal(v) for v in row_filter.values]
+        if sql_type:
+            column = f"TRY_CAST({column} AS {sql_type})"
+            values = [f"CAST({v} AS {sql_type})" for v in values]
+
+        operator = row_filter.operator.value
+        if operator in ("in", "not_in"):
+            negation = "NOT " if operator == "not_in" else ""
+            conditions.append(f"{column} {negation}IN ({', '.join(values)})")
+        else:
+            conditions.append(f"{column} {operator} {values[0]}")
+    return " AND ".join(conditions) or "true"
+
+
+# types inferred for the typed output in the order they are tried, VARCHAR is kept when none fits all sampled values
+INFERRED_TYPES = ("BIGINT", "DOUBLE", "TIMESTAMP")
+# integers with a leading zero are identifiers, the length limits keep the values within BIGINT and exact in DOUBLE
+INTEGER_PATTERN = "-?(0|[1-9][0-9]{0,17})"
+NUMBER_PATTERN = "-?(0|[1-9][0-9]{0,14})([.][0-9]+)?([eE][-+]?[0-9]+)?"
+
+
+def _typed_value(column: str, sql_type: str) -> str:
+    return f"TRY_CAST(NULLIF({quote_identifier(column)}, '') AS {sql_type})"
+
+
+def _conversion_failed(column: str, sql_type: str) -> str:
+    return f"(NULLIF({quote_identifier(column)}, '') IS NOT NULL AND {_typed_value(column, sql_type)} IS NULL)"
+
+
+def infer_types_sql(relation: str, columns: list[str], sample_rows: int) -> str:
+    """
+    Returns query counting for each column the sampled non-empty values and the values matching each
+    of INFERRED_TYPES, the result is interpreted by pick_types.
+
+    The rows are sampled from the whole relation, so columns present only in some of the files are sampled too.
+    """
+    counts = []
+    for column in columns:
+        value = f"NULLIF({quote_identifier(column)}, '')"
+        counts += [
+            f"count(*) FILTER (WHERE {value} IS NOT NULL)",
+            f"count_if(regexp_full_match({value}, {quote_literal(INTEGER_PATTERN)}))",
+            f"count_if(regexp_full_match({value}, {quote_literal(NUMBER_PATTERN)}))",
+            f"count(TRY_CAST({value} AS TIMESTAMP))",
+        ]
+    return f"SELECT {', '.join(counts)} FROM (SELECT * FROM {relation} USING SAMPLE reservoir({sample_rows} ROWS))"
+
+
+def pick_types(columns: list[str], counts: tuple) -> dict[str, str]:
+    """
+    Returns the first of INFERRED_TYPES matching all the sampled values of each column, VARCHAR if none does.
+    Columns without values in the sample are left out, their type is not known yet.
+    """
+    types = {}
+    for i, column in enumerate(columns):
+        values, *matches = counts[i * 4:i * 4 + 4]
+        if values:
+            types[column] = next((t for t, n in zip(INFERRED_TYPES, matches) if n == values), "VARCHAR")
+    return types
+
+
+def typed_select_sql(relation: str, types: dict[str, str]) -> str:
+    """
+    Returns query of the relation rows with values of all the typed columns converted, the rows
+    selected by quarantine_select_sql are left out.
+    """
+    typed = {c: t for c, t in types.items() if t != "VARCHAR"}
+    projection = ", ".join(
+        f"{_typed_value(c, typed[c])} AS {quote_identifier(c)}" if c in typed else quote_identifier(c) for c in types
+    )
+    failed = " OR ".join(_conversion_failed(c, t) for c, t in typed.items()) or "false"
+    return f"SELECT {projection} FROM {relation} WHERE NOT ({failed})"
+
+
+def quarantine_select_sql(relation: str, types: dict[str, str]) -> str:
+    """
+    Returns query of the relation rows with a value not convertible to the column type, with the original
+    values and names of the failed columns in quarantine_columns.
+    """
+    typed = {c: t for c, t in types.items() if t != "VARCHAR"}
+    failed_columns = ", ".join(
+        f"CASE WHEN {_conversion_failed(c, t)} THEN {quote_literal(c)} END" for c, t in typed.items()
+    )
+    failed = " OR ".join(_conversion_failed(c, t) for c, t in typed.items()) or "false"
+    projection = ", ".join(quote_identifier(c) for c in types)
+    return f"""
+        SELECT {projection}, concat_ws(',', {failed_columns or "NULL"}) AS quarantine_columns
+        FROM {relation} WHERE {failed}
+    """
+
+
+def parse_header(line: str, dialect: CsvDialect) -> list[str]:
+    quoting = csv.QUOTE_MINIMAL if dialect.quote and dialect.quote != "\0" else csv.QUOTE_NONE
+    reader = csv.reader([line], delimiter=dialect.delimiter, quotechar=dialect.quote or None, quoting=quoting)
+    return next(reader)
+
+
+def read_header(path: str, dialect: CsvDialect) -> Optional[list[str]]:
+    """
+    Returns column names from the first line of a gzipped CSV file, None if the file is empty.
+
+    Only the first line is decompressed, so it is cheap even for large files.
+    """
+    with gzip.open(path, "rt", encoding="utf-8", newline="") as f:
+        line = f.readline()
+    return parse_header(line.rstrip("\r\n"), dialect) if line else None
+
+
+class CsvScan:
+    """
+    Explicit DuckDB scan of CSV files with known headers.
+
+    Files with the same header are read by a single read_csv with the columns given, so DuckDB neither
+    sniffs the files nor resolves the union of their columns. The groups are combined with UNION ALL,
+    columns missing in a group are NULL.
+    """
+
+    def __init__(self, columns: list[str], groups: dict[tuple, list[str]], dialect: CsvDialect):
+        self.columns = columns
+        self.groups = groups
+        self.dialect = dialect
+
+    @classmethod
+    def from_files(cls, paths: list[str], dialect: CsvDialect, known_columns: Optional[list[str]] = None):
+        """
+        Reads headers of the files and builds the scan. Columns keep the order of known_columns,
+        columns not known yet are appended in the order they appear.
+
+        Returns None if any header can not be read or contains duplicate columns.
+        """
+        columns = list(known_columns or [])
+        known = set(columns)
+        groups: dict[tuple, list[str]] = {}
+        for path in paths:
+            try:
+                header = read_header(path, dialect)
+            except (OSError, EOFError, zlib.error, csv.Error, UnicodeDecodeError):
+                return None
+            if header is None:  # empty file contains no rows
+                continue
+            if len(set(header)) != len(header):
+                return None
+            groups.setdefault(tuple(header), []).append(path)
+            for column in header:
+                if column not in known:
+                    known.add(column)
+                    columns.append(column)
+
+        present = {column for header in groups for column in header}
+        return cls([c for c in columns if c in present], groups, dialect) if groups else None
+
+    def new_columns(self, known_columns: Optional[list[str]]) -> list[str]:
+        known = set(known_columns or [])
+        return [c for c in self.columns if c not in known]
+
+    def to_sql(self, filename: bool = False) -> str:
+        selects = []
+        for header, paths in self.groups.items():
+            present = set(header)
+            columns = ", ".join(f"{quote_literal(c)}: 'VARCHAR'" for c in header)
+            projection = ", ".join(
+                quote_identifier(c) if c in present else f"NULL::VARCHAR AS {quote_identifier(c)}" for c in self.columns
+            )
+            if filename:
+                projection += ", filename"
+            selects.append(f"""SELECT {projection} FROM read_csv(
+                [{", ".join(quote_literal(p) for p in paths)}],
+                header=true,
+                auto_detect=false,
+                delim={quote_literal(self.dialect.delimiter)},
+                quote={quote_literal(self.dialect.quote)},
+                escape={quote_literal(self.dialect.escape)},
+                columns={{{columns}}},
+                filename={str(filename).lower()}
+            )""")
+        return "(" + " UNION ALL ".join(selects) + ")"
@@ -0,0 +1,145 @@
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Optional
+
+SAMPLE_INTERVAL_SECONDS = 0.5
+
+
+def _current_rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def directory_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:  # file removed in the meantime
+                pass
+    return size
+
+
+class StageMetrics:
+    def __init__(self, stage: str, dataset: Optional[str]):
+        self.stage = stage
+        self.dataset = dataset
+        self.seconds = 0.0
+        self.counters = defaultdict(int)
+        self.peak_rss_bytes = 0
+        self.peak_spill_bytes = 0
+
+    def to_dict(self) -> dict:
+        counters = {name: round(v, 3) if isinstance(v, float) else v for name, v in self.counters.items()}
+        result = {"stage": self.stage, "dataset": self.dataset, "seconds": round(self.seconds, 3), **counters}
+        if self.seconds > 0:
+            for counter in ("bytes", "rows", "files"):
+                if self.counters.get(counter):
+                    result[f"{counter}_per_second"] = round(self.counters[counter] / self.seconds, 1)
+        result["peak_rss_bytes"] = self.peak_rss_bytes
+        result["peak_spill_bytes"] = self.peak_spill_bytes
+        return result
+
+
+class RunMetrics:
+    """
+    Collects wall time, counters (bytes, files, rows, ...), peak RSS and DuckDB spill size per stage and dataset.
+
+    Memory and spill size are sampled by a background thread and attributed to all stages running at the time.
+    """
+
+    def __init__(self, spill_directory: Optional[str] = None):
+        self.spill_directory = spill_directory
+        self._stages: dict[tuple[str, Optional[str]], StageMetrics] = {}
+        self._active: dict[tuple[str, Optional[str]], int] = defaultdict(int)
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._stop = threading.Event()
+        self._peak_spill_bytes = 0
+        self._sampler = threading.Thread(target=self._sample_loop, daemon=True)
+        self._sampler.start()
+
+    def _get(self, stage: str, dataset: Optional[str]) -> StageMetrics:
+        key = (stage, dataset)
+        if key not in self._stages:
+            self._stages[key] = StageMetrics(stage, dataset)
+        return self._stages[key]
+
+    @contextmanager
+    def stage(self, stage: str, dataset: Optional[str] = None):
+        key = (stage, dataset)
+        with self._lock:
+            metrics = self._get(stage, dataset)
+            self._active[key] += 1
+        start = time.perf_counter()
+        try:
+            yield metrics
+        finally:
+            self._sample()
+            with self._lock:
+                metrics.seconds += time.perf_counter() - start
+                self._active[key] -= 1
+
+    def add(self, stage: str, dataset: Optional[str] = None, **counters) -> None:
+        with self._lock:
+            metrics = self._get(stage, dataset)
+            for name, value in counters.items():
+                metrics.counters[name] += value
+
+    def _sample(self) -> None:
+        rss = _current_rss_bytes() or 0
+        spill = directory_size(self.spill_directory) if self.spill_directory else 0
+        with self._lock:
+            self._peak_spill_bytes = max(self._peak_spill_bytes, spill)
+            for key, count in self._active.items():
+                if count:
+                    metrics = self._stages[key]
+                    metrics.peak_rss_bytes = max(metrics.peak_rss_bytes, rss)
+                    metrics.peak_spill_bytes = max(metrics.peak_spill_bytes, spill)
+
+    def _sample_loop(self) -> None:
+        while not self._stop.wait(SAMPLE_INTERVAL_SECONDS):
+            self._sample()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._sampler.join()
+
+    def summary(self) -> dict:
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        with self._lock:
+            stages = [m.to_dict() for m in self._stages.values()]
+        return {
+            "total_seconds": round(time.perf_counter() - self._started, 3),
+            # ru_maxrss is in kilobytes on Linux
+            "peak_rss_bytes": self_usage.ru_maxrss * 1024,
+            "peak_children_rss_bytes": children_usage.ru_maxrss * 1024,
+            "peak_spill_bytes": self._peak_spill_bytes,
+            "stages": stages,
+        }
+
+    def log_summary(self, summary: dict) -> None:
+        totals = defaultdict(float)
+        for stage in summary["stages"]:
+            totals[stage["stage"]] += stage["seconds"]
+        parts = [f"total {summary['total_seconds']}s"]
+        parts += [f"{stage} {seconds:.3f}s" for stage, seconds in totals.items()]
+        parts.append(f"peak RSS {summary['peak_rss_bytes'] // 1024 // 1024} MB")
+        parts.append(f"peak spill {summary['peak_spill_bytes'] // 1024 // 1024} MB")
+        logging.info(f"Run metrics: {', '.join(parts)}")
+
+    @staticmethod
+    def write(summary: dict, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=2)
@@ -0,0 +1,93 @@
+import logging
+import os
+import shutil
+from dataclasses import dataclass
+from typing import Optional
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+# share of the container memory given to DuckDB, the rest is left for Python, download buffers and page cache
+DUCK_DB_MEMORY_SHARE = 0.6
+DUCK_DB_MIN_MEMORY_MB = 256
+# share of the free disk space DuckDB may use for spilling
+DUCK_DB_TEMP_DISK_SHARE = 0.8
+
+
+@dataclass
+class ResourceLimits:
+    cpus: int
+    memory_bytes: Optional[int]
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def detect_cpu_limit(cgroup_root: str = CGROUP_ROOT) -> int:
+    """
+    Returns number of CPUs available to the container based on the cgroup (v2 or v1) CPU quota,
+    falling back to the CPUs the process may run on.
+    """
+    try:
+        available = len(os.sched_getaffinity(0))
+    except AttributeError:
+        available = os.cpu_count() or 1
+
+    quota, period = None, None
+    cpu_max = _read(os.path.join(cgroup_root, "cpu.max"))  # cgroup v2: "<quota|max> <period>"
+    if cpu_max:
+        parts = cpu_max.split()
+        if parts[0] != "max" and len(parts) == 2:
+            quota, period = int(parts[0]), int(parts[1])
+    else:  # cgroup v1
+        v1_quota = _read(os.path.join(cgroup_root, "cpu", "cpu.cfs_quota_us"))
+        v1_period = _read(os.path.join(cgroup_root, "cpu", "cpu.cfs_period_us"))
+        if v1_quota and v1_period and int(v1_quota) > 0:
+            quota, period = int(v1_quota), int(v1_period)
+
+    if quota and period:
+        return max(1, min(available, quota // period))
+    return max(1, available)
+
+
+def detect_memory_limit(cgroup_root: str = CGROUP_ROOT) -> Optional[int]:
+    """
+    Returns memory available to the container in bytes based on the cgroup (v2 or v1) limit,
+    falling back to the physical memory of the host. None if it can not be determined.
+    """
+    try:
+        physical = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        physical = None
+
+    limit = _read(os.path.join(cgroup_root, "memory.max"))  # cgroup v2
+    if limit is None:
+        limit = _read(os.path.join(cgroup_root, "memory", "memory.limit_in_bytes"))  # cgroup v1
+    if limit and limit.isdigit():
+        # cgroup v1 reports a huge number when there is no limit
+        return min(int(limit), physical) if physical else int(limit)
+    return physical
+
+
+def detect_resource_limits(cgroup_root: str = CGROUP_ROOT) -> ResourceLimits:
+    return ResourceLimits(cpus=detect_cpu_limit(cgroup_root), memory_bytes=detect_memory_limit(cgroup_root))
+
+
+def duckdb_memory_limit(limits: ResourceLimits, default: str) -> str:
+    if not limits.memory_bytes:
+        return default
+    memory_mb = int(limits.memory_bytes * DUCK_DB_MEMORY_SHARE / 1024 / 1024)
+    return f"{max(DUCK_DB_MIN_MEMORY_MB, memory_mb)}MB"
+
+
+def duckdb_temp_directory_limit(temp_directory: str) -> Optional[str]:
+    try:
+        free_mb = int(shutil.disk_usage(temp_directory).free * DUCK_DB_TEMP_DISK_SHARE / 1024 / 1024)
+    except OSError as e:
+        logging.warning(f"Unable to determine free disk space of {temp_directory}: {e}")
+        return None
+    return f"{free_mb}MB"
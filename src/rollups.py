@@ -0,0 +1,99 @@
+from csv_scan import FILTER_SQL_TYPES, quote_identifier, quote_literal
+
+# aggregate combining the partial results of a measure computed by the batches
+MERGE_FUNCTIONS = {"count": "sum", "sum": "sum", "min": "min", "max": "max"}
+
+
+def rollup_columns(rollup) -> list[str]:
+    """
+    Returns the dataset columns read by the rollup (Rollup from the configuration).
+    """
+    columns = list(rollup.dimensions)
+    if rollup.time_column:
+        columns.append(rollup.time_column)
+    columns += [measure.column for measure in rollup.measures if measure.column]
+    return list(dict.fromkeys(columns))
+
+
+def _group_expressions(rollup) -> list[str]:
+    expressions = [quote_identifier(d) for d in rollup.dimensions]
+    if rollup.time_column:
+        column = quote_identifier(rollup.time_column)
+        expressions.append(f"date_trunc({quote_literal(rollup.time_grain.value)}, TRY_CAST({column} AS TIMESTAMP))")
+    return expressions
+
+
+def _measure_expression(measure) -> str:
+    if measure.column is None:
+        return "count(*)"
+    column = quote_identifier(measure.column)
+    sql_type = FILTER_SQL_TYPES.get(measure.data_type.value)
+    if sql_type:
+        column = f"TRY_CAST({column} AS {sql_type})"
+    return f"{measure.function.value}({column})"
+
+
+class RollupQuery:
+    """
+    Aggregates of all the rollups of a dataset computed by a single query.
+
+    Each rollup is one of the GROUPING SETS, so the dataset is scanned once for all of them. Rows of the result
+    belong to the rollup whose grouping matches the grouping_id column. Grouping and measure expressions shared
+    by more rollups are computed once.
+    """
+
+    def __init__(self, rollups: list):
+        self.rollups = rollups
+        self.groups: dict[str, str] = {}
+        self.measures: dict[str, str] = {}
+        for rollup in rollups:
+            for expression in _group_expressions(rollup):
+                self.groups.setdefault(expression, f"g{len(self.groups)}")
+            for measure in rollup.measures:
+                expression = _measure_expression(measure)
+                self.measures.setdefault(expression, f"m{len(self.measures)}")
+
+    def _grouping_set(self, rollup) -> list[str]:
+        return [self.groups[expression] for expression in _group_expressions(rollup)]
+
+    def _grouping_id(self, rollup) -> int:
+        # GROUPING sets the bit of each column not grouped by, the first column is the most significant bit
+        grouped = set(self._grouping_set(rollup))
+        aliases = list(self.groups.values())
+        return sum(1 << (len(aliases) - 1 - i) for i, alias in enumerate(aliases) if alias not in grouped)
+
+    def aggregate_sql(self, relation: str) -> str:
+        aliases = list(self.groups.values())
+        projection = ", ".join(f"{expression} AS {alias}" for expression, alias in self.groups.items())
+        measures = ", ".join(f"{expression} AS {alias}" for expression, alias in self.measures.items())
+        grouping_sets = list(dict.fromkeys(f"({', '.join(self._grouping_set(r))})" for r in self.rollups))
+        return f"""
+            SELECT {", ".join(aliases)}, GROUPING({", ".join(aliases)}) AS grouping_id, {measures}
+            FROM (SELECT *, {projection} FROM {relation})
+            GROUP BY GROUPING SETS ({", ".join(grouping_sets)})
+        """
+
+    def select_sql(self, aggregate_table: str, rollup) -> str:
+        """
+        Returns rows of the rollup from the aggregate table, with the dataset column and measure names.
+        """
+        names = list(rollup.dimensions) + ([rollup.time_column] if rollup.time_column else [])
+        columns = [f"{alias} AS {quote_identifier(name)}" for alias, name in zip(self._grouping_set(rollup), names)]
+        columns += [
+            f"{self.measures[_measure_expression(measure)]} AS {quote_identifier(measure.name)}"
+            for measure in rollup.measures
+        ]
+        return f"SELECT {', '.join(columns)} FROM {aggregate_table} WHERE grouping_id = {self._grouping_id(rollup)}"
+
+
+def merge_sql(table: str, rollup) -> str:
+    """
+    Returns the rollup rows with the partial results of the batches accumulated in the table merged.
+    """
+    names = list(rollup.dimensions) + ([rollup.time_column] if rollup.time_column else [])
+    groups = ", ".join(quote_identifier(name) for name in names)
+    measures = ", ".join(
+        f"{MERGE_FUNCTIONS[m.function.value]}({quote_identifier(m.name)}) AS {quote_identifier(m.name)}"
+        for m in rollup.measures
+    )
+    return f"SELECT {groups}, {measures} FROM {table} GROUP BY {groups}"
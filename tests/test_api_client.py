@@ -0,0 +1,232 @@
+import gzip
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+
+import mock
+import requests
+
+from client import api_client
+from client.api_client import AdaptiveConcurrencyLimiter, AdformClient
+
+
+def _response(status_code=200, chunks=(b"",), headers=None):
+    response = mock.MagicMock()
+    response.status_code = status_code
+    response.headers = headers or {}
+    response.__enter__.return_value = response
+    response.raw.stream.return_value = list(chunks)
+    if status_code >= 400:
+        error = requests.exceptions.HTTPError(f"{status_code} Error", response=response)
+        response.raise_for_status.side_effect = error
+    return response
+
+
+class TestAdaptiveConcurrencyLimiter(unittest.TestCase):
+    def test_decrease_halves_and_increase_recovers(self):
+        limiter = AdaptiveConcurrencyLimiter(8)
+        limiter.decrease()
+        limiter.decrease()
+        self.assertEqual(limiter.limit, 2)
+        for _ in range(10):
+            limiter.increase()
+        self.assertEqual(limiter.limit, 8)
+
+    def test_limit_never_drops_below_one(self):
+        limiter = AdaptiveConcurrencyLimiter(1)
+        limiter.decrease()
+        self.assertEqual(limiter.limit, 1)
+
+
+class TestAdformClientDownload(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.client = AdformClient("token", "setup", max_workers=2)
+
+    def tearDown(self):
+        self.client.close()
+        self.tmp_dir.cleanup()
+
+    def test_download_files_collects_results_and_errors(self):
+        files = [
+            {"id": "1", "name": "Click_1.csv.gz", "setup": "setup"},
+            {"id": "2", "name": "Click_2.csv.gz", "setup": "setup"},
+        ]
+        content = gzip.compress(b"abcdef")
+
+        def _get(url, **kwargs):
+            return _response(404) if url.endswith("/2") else _response(chunks=(content[:5], content[5:]))
+
+        with mock.patch.object(self.client._session, "get", side_effect=_get):
+            results = self.client.download_files(files, self.tmp_dir.name)
+
+        self.assertEqual([r.file["id"] for r in results], ["1", "2"])
+        self.assertIsNone(results[0].error)
+        self.assertEqual(results[0].size, len(content))
+        with open(os.path.join(self.tmp_dir.name, "Click_1.csv.gz"), "rb") as f:
+            self.assertEqual(f.read(), content)
+        self.assertIsInstance(results[1].error, requests.exceptions.HTTPError)
+
+    @mock.patch("time.sleep")
+    def test_throttled_download_is_retried_with_lower_concurrency(self, _):
+        file = {"id": "1", "name": "Click_1.csv.gz", "setup": "setup"}
+        responses = [_response(429), _response(chunks=(gzip.compress(b"data"),))]
+
+        with mock.patch.object(self.client._session, "get", side_effect=responses):
+            path = self.client.download_file(file, self.tmp_dir.name)
+
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(self.client.limiter.limit, 2)
+
+    def test_download_batches_yields_batches_in_order(self):
+        batches = [
+            [{"id": "1", "name": "Click_1.csv", "setup": "setup"}],
+            [{"id": "2", "name": "Event_1.csv", "setup": "setup"}, {"id": "3", "name": "Event_2.csv", "setup": "setup"}],
+        ]
+
+        with mock.patch.object(self.client._session, "get", side_effect=lambda *a, **k: _response()):
+            yielded = [[r.file["id"] for r in results] for results in self.client.download_batches(batches, self.tmp_dir.name)]
+
+        self.assertEqual(yielded, [["1"], ["2", "3"]])
+
+    @mock.patch("time.sleep")
+    def test_interrupted_download_is_resumed_with_range(self, _):
+        file = {"id": "1", "name": "Click_1.csv.gz", "setup": "setup"}
+        content = gzip.compress(b"a,b\n1,2\n")
+        responses = [
+            _response(chunks=(content[:10],), headers={"Content-Length": str(len(content))}),
+            _response(206, chunks=(content[10:],), headers={"Content-Range": f"bytes 10-/{len(content)}"}),
+        ]
+
+        with mock.patch.object(self.client._session, "get", side_effect=responses) as get:
+            path = self.client.download_file(file, self.tmp_dir.name)
+
+        self.assertEqual(get.call_args_list[1].kwargs["headers"], {"Range": "bytes=10-"})
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), content)
+        self.assertFalse(os.path.exists(path + ".part"))
+
+    @mock.patch("time.sleep")
+    def test_corrupted_gzip_is_not_kept(self, _):
+        file = {"id": "1", "name": "Click_1.csv.gz", "setup": "setup"}
+        responses = [_response(chunks=(b"not a gzip",))] * 5
+
+        with mock.patch.object(self.client._session, "get", side_effect=responses):
+            results = self.client.download_files([file], self.tmp_dir.name)
+
+        self.assertIsNotNone(results[0].error)
+        self.assertEqual(os.listdir(self.tmp_dir.name), [])
+
+    @mock.patch("time.sleep")
+    def test_corrupted_gzip_stops_download_at_first_bad_chunk(self, _):
+        file = {"id": "1", "name": "Click_1.csv.gz", "setup": "setup"}
+        members = gzip.compress(b"a,b\n") + gzip.compress(b"1,2\n") + b"\0\0"
+        corrupted = bytearray(gzip.compress(b"".join(b"%d,%d\n" % (i, i * i) for i in range(10000))))
+        corrupted[20:30] = b"x" * 10
+        sent = []
+
+        def _chunks(content):
+            for i in range(0, len(content), 10):
+                sent.append(i)
+                yield bytes(content[i:i + 10])
+
+        responses = [_response() for _ in range(api_client.DOWNLOAD_MAX_TRIES)]
+        for response in responses:
+            response.raw.stream.return_value = _chunks(corrupted)
+        with mock.patch.object(self.client._session, "get", side_effect=responses):
+            results = self.client.download_files([file], self.tmp_dir.name)
+        self.assertIsInstance(results[0].error, api_client.DownloadVerificationError)
+        # each attempt stops at the corrupted chunk instead of downloading the whole file
+        self.assertLess(len(sent), len(corrupted) // 10)
+
+        # multi-member files padded with zeroes are valid, truncated ones are not
+        with mock.patch.object(self.client._session, "get", return_value=_response(chunks=(members,))):
+            self.assertTrue(os.path.exists(self.client.download_file(file, self.tmp_dir.name)))
+        validator = api_client.GzipStreamValidator("Click_1.csv.gz")
+        validator.feed(members[:-12])
+        with self.assertRaises(api_client.DownloadVerificationError):
+            validator.close()
+
+    def test_read_file_head_stops_after_first_line(self):
+        file = {"id": "1", "name": "Click_1.csv.gz", "setup": "setup"}
+        content = gzip.compress(b"GUID,Name\n" + b"1,abc\n" * 100000)
+        response = _response(206, chunks=(content[:100], content[100:200], content[200:]))
+
+        with mock.patch.object(self.client._session, "get", return_value=response) as get:
+            head = self.client.read_file_head(file)
+
+        self.assertTrue(head.startswith(b"GUID,Name\n"))
+        self.assertEqual(get.call_args.kwargs["headers"], {"Range": f"bytes=0-{api_client.HEADER_PROBE_BYTES - 1}"})
+
+    def test_cached_file_is_not_downloaded_again(self):
+        cache_dir = os.path.join(self.tmp_dir.name, "cache")
+        out_dir = os.path.join(self.tmp_dir.name, "out")
+        os.makedirs(out_dir)
+        client = AdformClient("token", "setup", cache_dir=cache_dir)
+        file = {"id": "1", "name": "Click_1.csv", "setup": "setup"}
+
+        with mock.patch.object(client._session, "get", return_value=_response(chunks=(b"data",))) as get:
+            client.download_file(file, out_dir)
+            os.remove(os.path.join(out_dir, "Click_1.csv"))
+            path = client.download_file(file, out_dir)
+
+        self.assertEqual(get.call_count, 1)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"data")
+        client.close()
+
+
+class TestAdformClientFileList(unittest.TestCase):
+    START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def setUp(self):
+        self.client = AdformClient("token", "setup", max_workers=2)
+
+    def tearDown(self):
+        self.client.close()
+
+    def _catalogue(self, count, descending=True):
+        files = []
+        for i in range(count):
+            created = self.START + timedelta(hours=i)
+            prefix = "Click" if i % 2 else "Impression"
+            files.append({"id": str(i), "name": f"{prefix}_{i}.csv.gz", "createdAt": created.strftime("%Y-%m-%dT%H:%M:%SZ")})
+        return list(reversed(files)) if descending else files
+
+    def _mock_pages(self, files, total_count=True):
+        def _get(url, params=None, headers=None):
+            response = mock.MagicMock()
+            response.headers = {"Total-Count": str(len(files))} if total_count else {}
+            response.json.return_value = files[params["offset"]:params["offset"] + params["limit"]]
+            return response
+
+        return mock.patch.object(self.client._session, "get", side_effect=_get)
+
+    @mock.patch.object(api_client, "PAGE_SIZE", 10)
+    def test_all_pages_are_listed_in_order(self):
+        files = self._catalogue(35, descending=False)
+        for total_count in (True, False):
+            with self._mock_pages(files, total_count):
+                listed = list(self.client.retrieve_file_list())
+            self.assertEqual(listed, files)
+
+    @mock.patch.object(api_client, "PAGE_SIZE", 10)
+    def test_listing_grouped_by_dataset_reads_all_pages(self):
+        files = []
+        for prefix in ("Click", "Event", "Impression"):
+            for hour in range(24):
+                created = (self.START + timedelta(hours=hour)).strftime("%Y-%m-%dT%H:%M:%SZ")
+                files.append({"id": f"{prefix}-{hour}", "name": f"{prefix}_{hour}.csv.gz", "createdAt": created})
+
+        for listing in (files, list(reversed(files))):
+            with self._mock_pages(listing) as get:
+                listed = list(self.client.retrieve_file_list(
+                    self.START + timedelta(hours=10), self.START + timedelta(hours=15), ["Click", "Impression"]
+                ))
+            self.assertEqual(len(listed), 12)
+            self.assertEqual(get.call_count, 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+from datetime import datetime, timezone
+
+from catalogue import FileCatalogue
+
+
+def _file(file_id, name, created_at, size=100):
+    return {"id": file_id, "name": name, "setup": "setup", "createdAt": created_at, "size": size}
+
+
+def _time(day, hour):
+    return datetime(2024, 1, day, hour, tzinfo=timezone.utc)
+
+
+class TestFileCatalogue(unittest.TestCase):
+    def test_select(self):
+        catalogue = FileCatalogue("setup", ["Click", "Impression"])
+        catalogue.update([
+            _file("c2", "Click_2.csv.gz", "2024-01-01T11:00:00Z"),
+            _file("c1", "Click_1.csv.gz", "2024-01-01T10:00:00Z", size=None),
+            _file("i1", "Impression_1.csv.gz", "2024-01-01T12:00:00Z"),
+            _file("e1", "Event_1.csv.gz", "2024-01-01T11:00:00Z"),
+        ])
+        # files added again are indexed only once, files created before the others are inserted in order
+        catalogue.update([
+            _file("c2", "Click_2.csv.gz", "2024-01-01T11:00:00Z"),
+            _file("c0", "Click_0.csv.gz", "2024-01-01T09:00:00Z"),
+        ])
+
+        self.assertEqual(len(catalogue), 4)
+        self.assertEqual(catalogue.select(_time(1, 10), _time(1, 12), ["Click"]), [
+            {"id": "c1", "name": "Click_1.csv.gz", "setup": "setup", "createdAt": "2024-01-01T10:00:00Z"},
+            _file("c2", "Click_2.csv.gz", "2024-01-01T11:00:00Z"),
+        ])
+        self.assertEqual([f["id"] for f in catalogue.select(_time(1, 0), _time(2, 0), ["Impression"])], ["i1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,12 +3,26 @@ Created on 12. 11. 2018
 
 @author: esner
 '''
+import gzip
+import json
+import re
+import tempfile
+import threading
 import unittest
 import mock
 import os
+from datetime import datetime, timedelta, timezone
 from freezegun import freeze_time
 
+import duckdb
+
+from keboola.component.exceptions import UserException
+
+from client import api_client
+from client.api_client import AdformClient, DownloadResult, DownloadVerificationError
 from component import Component
+from csv_scan import CsvDialect, CsvScan
+from metrics import RunMetrics
 
 
 class TestComponent(unittest.TestCase):
@@ -22,6 +36,284 @@ class TestComponent(unittest.TestCase):
             comp = Component()
             comp.run()
 
+    def test_token_is_persisted_in_background(self):
+        comp = Component.__new__(Component)
+        comp.state = {"processed_files": {"Click": {}}}
+        comp.credentials = {"id": "auth"}
+        comp.environment_variables = mock.MagicMock(stack_id="connection.keboola.com")
+        comp._token_persistence = None
+        encrypt_started, release = threading.Event(), threading.Event()
+
+        def _encrypt(token):
+            encrypt_started.set()
+            release.wait(5)
+            return f"encrypted-{token}"
+
+        with (
+            mock.patch.object(Component, "write_state_file"),
+            mock.patch.object(Component, "encrypt", side_effect=_encrypt),
+            mock.patch.object(Component, "update_config_state_api") as update,
+        ):
+            comp.save_new_token("new-token")
+            self.assertTrue(encrypt_started.wait(5))
+            # the state changed by the run does not affect the state being saved
+            comp.state["processed_files"]["Click"] = {"files": {"1": "2024-01-01T00:00:00Z"}}
+            update.assert_not_called()
+            release.set()
+            comp.wait_for_token_persistence()
+
+        state = update.call_args.kwargs["state"]["component"]
+        self.assertEqual(state["#refresh_token"], "encrypted-new-token")
+        self.assertEqual(state["processed_files"], {"Click": {}})
+
+    def test_skip_processed_files(self):
+        files = [
+            {"id": "c1", "name": "Click_1.csv.gz", "createdAt": "2024-01-01T10:00:00Z"},
+            {"id": "c2", "name": "Click_2.csv.gz", "createdAt": "2024-01-01T11:00:00Z"},
+            {"id": "i1", "name": "Impression_1.csv.gz", "createdAt": "2024-01-01T11:00:00Z"},
+        ]
+        processed = {"Click": {"last_created_at": "2024-01-01T10:00:00Z", "files": {"c1": "2024-01-01T10:00:00Z"}}}
+
+        filtered = Component.skip_processed_files(files, processed)
+
+        self.assertEqual([f["id"] for f in filtered], ["c2", "i1"])
+
+    def test_list_files_selects_late_files_of_grouped_listing(self):
+        comp = Component.__new__(Component)
+        comp.metrics = RunMetrics()
+        comp.state = {"file_catalogue": {"version": 2}}
+        files = [
+            {"id": f"{prefix}-{hour}", "name": f"{prefix}_{hour}.csv.gz",
+             "createdAt": f"2024-01-01T{hour:02d}:00:00Z"}
+            for prefix in ("Click", "Event", "Impression") for hour in range(24)
+        ]
+        client = AdformClient("token", "setup", max_workers=2)
+        start, end = datetime(2024, 1, 1, 10, tzinfo=timezone.utc), datetime(2024, 1, 1, 15, tzinfo=timezone.utc)
+
+        with (
+            mock.patch.object(api_client, "PAGE_SIZE", 10),
+            mock.patch.object(client, "_get_file_list_page", side_effect=lambda o: (files[o:o + 10], len(files))),
+        ):
+            listed = comp.list_files(client, start, end, ["Click", "Impression"])
+            # a file published after the previous run with an older createdAt is selected by the next run
+            files.insert(0, {"id": "late", "name": "Click_late.csv.gz", "createdAt": "2024-01-01T11:30:00Z"})
+            listed_again = comp.list_files(client, start, end + timedelta(hours=1), ["Click", "Impression"])
+
+        client.close()
+        comp.metrics.close()
+        self.assertEqual(len(listed), 12)
+        self.assertEqual(len(listed_again), 15)
+        self.assertIn("late", [f["id"] for f in listed_again])
+        self.assertNotIn("file_catalogue", comp.state)
+
+    def test_update_processed_files_prunes_files_before_window(self):
+        processed = {
+            "Click": {
+                "last_created_at": "2024-01-01T10:00:00Z",
+                "files": {"c0": "2023-12-30T10:00:00Z", "c1": "2024-01-01T10:00:00Z"},
+            },
+            "Event": {"last_created_at": "2023-12-30T10:00:00Z", "files": {"e0": "2023-12-30T10:00:00Z"}},
+        }
+        new_files = [{"id": "c2", "name": "Click_2.csv.gz", "createdAt": "2024-01-01T11:00:00Z"}]
+
+        updated = Component.update_processed_files(
+            processed, new_files, ["Click"], datetime(2024, 1, 1, tzinfo=timezone.utc)
+        )
+
+        self.assertEqual(updated["Click"]["last_created_at"], "2024-01-01T11:00:00Z")
+        self.assertEqual(set(updated["Click"]["files"]), {"c1", "c2"})
+        self.assertEqual(updated["Event"], {"last_created_at": "2023-12-30T10:00:00Z", "files": {}})
+
+    def test_transcode_to_utf8_outputs_gzipped_utf8(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            names = ["Click_1.csv.gz", "Click_2.csv.gz"]
+            for name in names:
+                with gzip.open(os.path.join(tmp_dir, name), "wb") as f:
+                    f.write("GUID,Name\n1,Ærø\n".encode("cp850"))
+
+            paths = Component.transcode_to_utf8(names, "IBM850", tmp_dir, os.path.join(tmp_dir, "utf8"))
+
+            self.assertEqual(len(paths), 2)
+            for path in paths:
+                with gzip.open(path, "rt", encoding="utf-8") as f:
+                    self.assertEqual(f.read(), "GUID,Name\n1,Ærø\n")
+
+    def test_split_into_batches_respects_budget(self):
+        files = [{"id": str(i), "size": size} for i, size in enumerate([40, 30, 50, 100, None, 10])]
+
+        batches = Component.split_into_batches(files, 80)
+
+        # the file without size is counted as the average size (46)
+        self.assertEqual([[f["id"] for f in batch] for batch in batches], [["0", "1"], ["2"], ["3"], ["4", "5"]])
+        self.assertEqual(len(Component.split_into_batches([{"id": "1"}, {"id": "2"}], 1)), 1)
+
+    def test_backfill_windows_skip_completed(self):
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        end = datetime(2024, 1, 2, 4, tzinfo=timezone.utc)
+        windows = Component.split_into_windows(start, end, 12)
+        self.assertEqual([w[1].hour for w in windows], [12, 0, 4])
+
+        files = [
+            {"id": "1", "createdAt": "2024-01-01T00:00:00Z"},
+            {"id": "2", "createdAt": "2024-01-01T12:00:00Z"},
+            {"id": "3", "createdAt": "2024-01-02T04:00:00Z"},
+            {"id": "4", "createdAt": "2024-01-02T04:00:01Z"},
+        ]
+        window_files = Component.assign_files_to_windows(files, windows)
+        self.assertEqual([[f["id"] for f in window_files[w[0]]] for w in windows], [["1"], ["2"], ["3"]])
+
+        comp = Component.__new__(Component)
+        backfill = mock.MagicMock(window_hours=12)
+        comp.state = {"backfill": {"date_from": "2024-01-01T00:00:00Z", "date_to": "2024-01-02T04:00:00Z",
+                                   "window_hours": 12, "completed": ["2024-01-01T00:00:00Z"]}}
+        self.assertEqual(comp._backfill_checkpoint(backfill, start, end)["completed"], ["2024-01-01T00:00:00Z"])
+        # a changed range is loaded from the beginning
+        self.assertEqual(comp._backfill_checkpoint(backfill, start, end + timedelta(hours=1))["completed"], [])
+
+    def test_corrupted_files_are_quarantined(self):
+        comp = Component.__new__(Component)
+        comp.metrics = RunMetrics()
+        comp.quarantined_files = {}
+        files = [{"id": str(i), "name": f"Click_{i}.csv.gz"} for i in range(3)]
+        results = [
+            DownloadResult(file=files[0], path="/tmp/Click_0.csv.gz"),
+            DownloadResult(file=files[1], error=DownloadVerificationError("not a valid gzip")),
+        ]
+
+        self.assertEqual(comp._check_download_results(results), {"1"})
+        self.assertEqual(list(comp.quarantined_files), ["1"])
+        with self.assertRaises(UserException):
+            comp._check_download_results([DownloadResult(file=files[2], error=OSError("disk full"))])
+        comp.metrics.close()
+
+    def test_deduplicate_rows_keeps_row_from_latest_file(self):
+        header = 'GUID,"Ra""nk"\n'
+        files = [
+            {"name": "Click_1.csv.gz", "createdAt": "2024-01-01T10:00:00Z", "content": header + "a,2\nb,1\n"},
+            {"name": "Click_2.csv.gz", "createdAt": "2024-01-01T11:00:00Z", "content": header + "a,1\nc,1\n"},
+        ]
+        comp = Component.__new__(Component)
+        comp.metrics = RunMetrics()
+        comp.scans = {}
+        comp.selections = {}
+        results = {}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for f in files:
+                with gzip.open(os.path.join(tmp_dir, f["name"]), "wt") as out:
+                    out.write(f["content"])
+
+            for order_by in (None, 'Ra"nk'):
+                comp.duck = duckdb.connect()
+                comp.dedup_order_by = order_by
+                relation = comp.deduplicate_rows("Click", tmp_dir, ["GUID"], files, ["GUID", 'Ra"nk'])
+                results[order_by] = comp.duck.execute(f"SELECT * FROM {relation} ORDER BY GUID").fetchall()
+            comp.dedup_order_by = "Rank"
+            with self.assertRaises(UserException):
+                comp.deduplicate_rows("Click", tmp_dir, ["GUID"], files, ["GUID", 'Ra"nk'])
+
+        comp.metrics.close()
+        self.assertEqual(results[None], [("a", "1"), ("b", "1"), ("c", "1")])
+        self.assertEqual(results['Ra"nk'], [("a", "2"), ("b", "1"), ("c", "1")])
+        stages = {(m["stage"], m["dataset"]): m for m in comp.metrics.summary()["stages"]}
+        self.assertEqual(stages[("dedup", "Click")]["rows_dropped"], 2)
+
+    def test_sliced_output_batches(self):
+        comp = Component.__new__(Component)
+        comp.metrics = RunMetrics()
+        comp.environment_variables = mock.MagicMock(stack_id=None)
+        comp.slice_size_mb = 1
+        comp.duck = duckdb.connect(config={"threads": 1})
+        # md5 values do not compress, so the first batch is split into several slices
+        comp.duck.execute(
+            "CREATE TABLE batch_0 AS SELECT range::VARCHAR AS GUID, md5(range::VARCHAR) AS V FROM range(150000)"
+        )
+        comp.duck.execute("CREATE TABLE batch_1 AS SELECT range::VARCHAR AS GUID, 'x' AS V FROM range(150000, 150010)")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, "config.json"), "w") as f:
+                f.write('{"parameters": {}}')
+            comp.data_folder_path = tmp_dir
+            os.makedirs(comp.tables_out_path)
+
+            out_table, primary_key = comp._create_dataset_table(
+                "Click", [("GUID", "VARCHAR"), ("V", "VARCHAR")], None, True
+            )
+            comp.copy_to_output("batch_0", out_table, "Click")
+            comp.copy_to_output("batch_1", out_table, "Click", batch=1)
+            comp.write_manifest(out_table)
+
+            slices = sorted(os.listdir(out_table.full_path))
+            slices_glob = os.path.join(out_table.full_path, "*.csv.gz")
+            rows = comp.duck.execute(
+                f"SELECT count(*), count(DISTINCT column0) FROM read_csv('{slices_glob}', header=false)"
+            ).fetchone()
+            with open(out_table.full_path + ".manifest") as f:
+                manifest = json.load(f)
+
+        comp.metrics.close()
+        self.assertTrue(out_table.is_sliced)
+        self.assertEqual(primary_key, ["GUID"])
+        self.assertEqual(slices[0], "batch1_0.csv.gz")
+        self.assertGreater(len(slices), 2)
+        self.assertTrue(all(re.fullmatch(r"data_\d+\.csv\.gz", name) for name in slices[1:]))
+        # the rows are not duplicated by the header, which the slices do not have
+        self.assertEqual(rows, (150010, 150010))
+        self.assertFalse(manifest["has_header"])
+        self.assertTrue(manifest["incremental"])
+
+    @mock.patch("component.TYPE_SAMPLE_ROWS", 20)
+    def test_column_of_later_file_group_is_typed(self):
+        comp = Component.__new__(Component)
+        comp.duck = duckdb.connect()
+        comp.metrics = RunMetrics()
+        comp.state = {}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            contents = {
+                "Click_1.csv.gz": "GUID,Name\n" + "".join(f"{i},n{i}\n" for i in range(50)),
+                "Click_2.csv.gz": "GUID,Name,DeviceTypeId,Empty\n" + "".join(f"{i},n{i},{i % 3},\n" for i in range(50)),
+            }
+            paths = []
+            for name, content in contents.items():
+                paths.append(os.path.join(tmp_dir, name))
+                with gzip.open(paths[-1], "wt") as f:
+                    f.write(content)
+            comp.duck.execute(f"CREATE VIEW Click AS SELECT * FROM {CsvScan.from_files(paths, CsvDialect()).to_sql()}")
+
+            types = comp.infer_column_types("Click", ["GUID", "Name", "DeviceTypeId", "Empty"])
+
+        comp.metrics.close()
+        self.assertEqual(types, {"GUID": "BIGINT", "Name": "VARCHAR", "DeviceTypeId": "BIGINT", "Empty": "VARCHAR"})
+        # the column without values is inferred again by the next run
+        self.assertNotIn("Empty", comp.state["dataset_columns"]["Click"]["types"])
+
+    def test_unchanged_meta_zip_is_skipped(self):
+        comp = Component.__new__(Component)
+        comp.metrics = RunMetrics()
+        comp.state = {}
+        fingerprint = {"etag": '"abc"', "size": "10"}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            def _download(file_dict, dir_path, use_cache=True):
+                path = os.path.join(tmp_dir, file_dict["name"])
+                with open(path, "wb") as f:
+                    f.write(b"meta")
+                return path
+
+            client = mock.MagicMock()
+            client.get_file_fingerprint.return_value = fingerprint
+            client.download_file.side_effect = _download
+            with mock.patch.object(Component, "save_metadata_tables", side_effect=lambda path, dims: dims) as save:
+                comp.process_meta_files(client, "setup", ["campaigns"], always_get_meta=False)
+                comp.process_meta_files(client, "setup", ["campaigns"], always_get_meta=False)
+                # a new dimension is loaded even if the archive has not changed
+                comp.process_meta_files(client, "setup", ["campaigns", "browsers"], always_get_meta=False)
+                comp.process_meta_files(client, "setup", ["campaigns", "browsers"], always_get_meta=True)
+
+        comp.metrics.close()
+        self.assertEqual(client.download_file.call_count, 3)
+        self.assertEqual(
+            [c.args[1] for c in save.call_args_list], [["campaigns"], ["browsers"], ["campaigns", "browsers"]]
+        )
+        self.assertEqual(comp.state["meta_zip"]["dimensions"], ["browsers", "campaigns"])
+
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
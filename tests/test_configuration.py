@@ -0,0 +1,28 @@
+import unittest
+
+from keboola.component.exceptions import UserException
+
+from configuration import Configuration
+
+SOURCE = {"setup_id": "setup", "days_interval": 1, "hours_interval": 0, "date_to": ""}
+DESTINATION = {"override_pkey": []}
+
+
+class TestConfiguration(unittest.TestCase):
+    def test_backfill_without_dates_is_not_configured(self):
+        form_backfill = {"date_from": "", "date_to": "", "window_hours": 24, "parallel_windows": 2,
+                         "max_runtime_minutes": 0}
+        params = Configuration(source={**SOURCE, "backfill": form_backfill}, destination=DESTINATION)
+        self.assertIsNone(params.source.backfill)
+
+        params = Configuration(
+            source={**SOURCE, "backfill": {"date_from": "01-01-2024 00:00", "date_to": "", "window_hours": 12}},
+            destination=DESTINATION,
+        )
+        self.assertEqual(params.source.backfill.window_hours, 12)
+        with self.assertRaises(UserException):
+            Configuration(source={**SOURCE, "backfill": {"date_from": "01-01-2024 00:00"}}, destination=DESTINATION)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+import gzip
+import os
+import tempfile
+import unittest
+
+import duckdb
+
+from configuration import RowFilter
+from csv_scan import (
+    CsvDialect,
+    CsvScan,
+    infer_types_sql,
+    pick_types,
+    quarantine_select_sql,
+    row_filter_sql,
+    typed_select_sql,
+)
+
+
+class TestCsvScan(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _write(self, name, content, compress=True):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, "wb") as f:
+            f.write(gzip.compress(content.encode()) if compress else content.encode())
+        return path
+
+    def test_scan_matches_union_by_name(self):
+        paths = [
+            self._write("Click_1.csv.gz", 'GUID,CityName\n1,"Praha, CZ"\n'),
+            self._write("Click_2.csv.gz", "GUID,BrowserName,CityName\n2,Firefox,Brno\n"),
+            self._write("Click_3.csv.gz", ""),
+        ]
+
+        scan = CsvScan.from_files(paths, CsvDialect(), known_columns=["CityName", "Removed"])
+        self.assertEqual(scan.columns, ["CityName", "GUID", "BrowserName"])
+        self.assertEqual(scan.new_columns(["CityName", "Removed"]), ["GUID", "BrowserName"])
+
+        duck = duckdb.connect()
+        rows = duck.execute(f"SELECT GUID, CityName, BrowserName FROM {scan.to_sql()} ORDER BY GUID").fetchall()
+        expected = duck.execute(f"""
+            SELECT GUID, CityName, BrowserName
+            FROM read_csv('{self.tmp_dir.name}/Click_[12].csv.gz', union_by_name=true, all_varchar=true)
+            ORDER BY GUID
+        """).fetchall()
+        self.assertEqual(rows, expected)
+        self.assertEqual(rows, [("1", "Praha, CZ", None), ("2", "Brno", "Firefox")])
+
+    def test_unreadable_header_falls_back(self):
+        paths = [
+            self._write("Click_1.csv.gz", "GUID\n1\n"),
+            self._write("Click_2.csv.gz", "GUID\n2\n", compress=False),
+        ]
+        self.assertIsNone(CsvScan.from_files(paths, CsvDialect()))
+
+        duplicate = [self._write("Click_3.csv.gz", "GUID,GUID\n1,1\n")]
+        self.assertIsNone(CsvScan.from_files(duplicate, CsvDialect()))
+
+    def test_row_filter_sql(self):
+        filters = [
+            RowFilter(column="CampaignId", operator=">=", values=["10"], data_type="integer"),
+            RowFilter(column="Browser", operator="not_in", values=["Bot", "O'Crawler"]),
+        ]
+        rows = [("9", "Firefox"), ("10", "Firefox"), ("abc", "Firefox"), ("11", "O'Crawler"), ("100", None)]
+
+        duck = duckdb.connect()
+        duck.execute('CREATE TABLE t ("CampaignId" VARCHAR, "Browser" VARCHAR)')
+        duck.executemany("INSERT INTO t VALUES (?, ?)", rows)
+        selected = duck.execute(f"SELECT * FROM t WHERE {row_filter_sql(filters)}").fetchall()
+
+        self.assertEqual(selected, [("10", "Firefox")])
+        self.assertEqual(row_filter_sql([]), "true")
+        with self.assertRaises(ValueError):
+            RowFilter(column="CampaignId", operator="=", values=["1", "2"])
+
+    def test_typed_columns_and_quarantine(self):
+        duck = duckdb.connect()
+        duck.execute('CREATE TABLE t ("Id" VARCHAR, "Zip" VARCHAR, "Cost" VARCHAR, "Time" VARCHAR, "Empty" VARCHAR)')
+        duck.executemany("INSERT INTO t VALUES (?, ?, ?, ?, ?)", [
+            ("1", "01234", "1.5", "2024-01-01 10:00:00", None),
+            ("2", "12345", "2", "2024-01-01 11:00:00", ""),
+        ])
+        columns = ["Id", "Zip", "Cost", "Time", "Empty"]
+        types = pick_types(columns, duck.execute(infer_types_sql("t", columns, 100)).fetchone())
+        # the type of a column without values is not known
+        self.assertEqual(types, {"Id": "BIGINT", "Zip": "VARCHAR", "Cost": "DOUBLE", "Time": "TIMESTAMP"})
+        types["Empty"] = "VARCHAR"
+
+        duck.execute("INSERT INTO t VALUES ('x', '1', '', 'yesterday', NULL), ('3', '1', '', NULL, NULL)")
+        typed = duck.execute(f"SELECT Id, Cost, Time FROM ({typed_select_sql('t', types)}) ORDER BY Id").fetchall()
+        self.assertEqual([row[:2] for row in typed], [(1, 1.5), (2, 2.0), (3, None)])
+        quarantined = duck.execute(quarantine_select_sql("t", types)).fetchall()
+        self.assertEqual([(row[0], row[-1]) for row in quarantined], [("x", "Id,Time")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,18 @@
+import unittest
+
+from metrics import RunMetrics
+
+
+class TestRunMetrics(unittest.TestCase):
+    def test_summary_without_stages_is_logged(self):
+        metrics = RunMetrics()
+        metrics.close()
+
+        with self.assertLogs(level="INFO") as logs:
+            metrics.log_summary(metrics.summary())
+
+        self.assertRegex(logs.output[0], r"Run metrics: total [\d.]+s, peak RSS \d+ MB, peak spill \d+ MB$")
+
+
+if __name__ == "__main__":
+    unittest.main()
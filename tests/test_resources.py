@@ -0,0 +1,39 @@
+import os
+import tempfile
+import unittest
+
+from resources import ResourceLimits, detect_cpu_limit, detect_memory_limit, duckdb_memory_limit
+
+
+class TestResources(unittest.TestCase):
+    def setUp(self):
+        self.cgroup_dir = tempfile.TemporaryDirectory()
+        self.root = self.cgroup_dir.name
+
+    def tearDown(self):
+        self.cgroup_dir.cleanup()
+
+    def _write(self, path, content):
+        full_path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "w") as f:
+            f.write(content)
+
+    def test_cgroup_v2_limits(self):
+        self._write("cpu.max", "100000 100000\n")
+        self._write("memory.max", "1073741824\n")
+        self.assertEqual(detect_cpu_limit(self.root), 1)
+        self.assertLessEqual(detect_memory_limit(self.root), 1073741824)
+
+    def test_cgroup_v1_unlimited_cpu_falls_back_to_available(self):
+        self._write("cpu/cpu.cfs_quota_us", "-1")
+        self._write("cpu/cpu.cfs_period_us", "100000")
+        self.assertEqual(detect_cpu_limit(self.root), len(os.sched_getaffinity(0)))
+
+    def test_duckdb_memory_limit(self):
+        self.assertEqual(duckdb_memory_limit(ResourceLimits(cpus=2, memory_bytes=8 * 1024 ** 3), "400MB"), "4915MB")
+        self.assertEqual(duckdb_memory_limit(ResourceLimits(cpus=2, memory_bytes=None), "400MB"), "400MB")
+
+
+if __name__ == "__main__":
+    unittest.main()
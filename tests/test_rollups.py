@@ -0,0 +1,63 @@
+import unittest
+
+import duckdb
+
+from configuration import Rollup
+from rollups import RollupQuery, merge_sql, rollup_columns
+
+
+class TestRollups(unittest.TestCase):
+    def setUp(self):
+        self.duck = duckdb.connect()
+        self.duck.execute('CREATE TABLE Click ("Timestamp" VARCHAR, "CampaignId" VARCHAR, "Cost" VARCHAR)')
+        self.rows = [
+            ("2024-01-01 10:05:00", "1", "1.5"),
+            ("2024-01-01 10:55:00", "1", "2"),
+            ("2024-01-01 11:00:00", "1", "x"),
+            ("2024-01-01 11:30:00", "2", "4"),
+        ]
+        self.hourly = Rollup(
+            name="clicks_hourly",
+            dataset="Click",
+            dimensions=["CampaignId"],
+            time_column="Timestamp",
+            measures=[{"name": "clicks"}, {"name": "cost", "function": "sum", "column": "Cost"}],
+        )
+        self.daily = Rollup(name="clicks_daily", dataset="Click", time_column="Timestamp", time_grain="day")
+
+    def _rollup_rows(self, query, rollup):
+        self.duck.execute(f"CREATE OR REPLACE TABLE aggregate AS {query.aggregate_sql('Click')}")
+        return sorted(self.duck.execute(query.select_sql("aggregate", rollup)).fetchall(), key=str)
+
+    def test_rollups_share_single_query(self):
+        self.duck.executemany("INSERT INTO Click VALUES (?, ?, ?)", self.rows)
+        query = RollupQuery([self.hourly, self.daily])
+
+        hourly = self._rollup_rows(query, self.hourly)
+        self.assertEqual(
+            [(r[0], r[1].hour, r[2], r[3]) for r in hourly], [("1", 10, 2, 3.5), ("1", 11, 1, None), ("2", 11, 1, 4.0)]
+        )
+        daily = self._rollup_rows(query, self.daily)
+        self.assertEqual([(r[0].day, r[1]) for r in daily], [(1, 4)])
+        self.assertEqual(rollup_columns(self.hourly), ["CampaignId", "Timestamp", "Cost"])
+
+    def test_batches_are_merged(self):
+        query = RollupQuery([self.hourly])
+        self.duck.execute("CREATE TABLE partial (CampaignId VARCHAR, Timestamp TIMESTAMP, clicks BIGINT, cost DOUBLE)")
+        for rows in (self.rows[:2], self.rows[2:3]):
+            self.duck.execute("DELETE FROM Click")
+            self.duck.executemany("INSERT INTO Click VALUES (?, ?, ?)", rows)
+            self.duck.execute(f"CREATE OR REPLACE TABLE aggregate AS {query.aggregate_sql('Click')}")
+            self.duck.execute(f"INSERT INTO partial {query.select_sql('aggregate', self.hourly)}")
+        self.duck.execute("INSERT INTO partial VALUES ('1', '2024-01-01 10:00:00', 1, 1.0)")
+
+        merged = sorted(self.duck.execute(merge_sql("partial", self.hourly)).fetchall(), key=str)
+        self.assertEqual([(r[0], r[1].hour, r[2], r[3]) for r in merged], [("1", 10, 3, 4.5), ("1", 11, 1, None)])
+
+    def test_measure_requires_column(self):
+        with self.assertRaises(ValueError):
+            Rollup(name="r", dataset="Click", dimensions=["CampaignId"], measures=[{"name": "cost", "function": "sum"}])
+
+
+if __name__ == "__main__":
+    unittest.main()